@@ -0,0 +1,184 @@
+from typing import List, Optional
+from collections import Counter
+from env import settings, logger
+from io import BytesIO
+from PIL import Image
+from requests.adapters import HTTPAdapter
+import base64
+import hashlib
+import re
+import requests
+
+# 这些头像服务生成的都是默认/占位头像(首字母, identicon等), 对分析用户没有帮助
+DEFAULT_AVATAR_PATTERNS: List[re.Pattern] = [
+    re.compile(p)
+    for p in [
+        r"cdn\.auth0\.com/avatars/",
+        r"googleusercontent\.com/a/default-user",
+        r"gravatar\.com/avatar/.*[?&]d=(identicon|mp|mm|retro|monsterid|wavatar|robohash|blank)",
+        r"ui-avatars\.com/api",
+        r"api\.dicebear\.com/",
+        r"robohash\.org/",
+        r"/identicons?/",
+    ]
+]
+
+
+class Avatar(object):
+    def __init__(self, url: str):
+        self.url: str = url
+        self.digest: str = ""
+        self.data_url: str = ""
+
+
+class AvatarProcessor(object):
+    """
+    调用vision模型前对头像做预处理:
+    - 用连接池拉取头像, 失效的url快速失败
+    - 通过url规则和感知哈希识别默认/占位头像并跳过
+    - 缩小尺寸后转成base64, 以low detail发给模型
+    """
+
+    def __init__(self):
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=settings.avatar_pool_size,
+            pool_maxsize=settings.avatar_pool_size,
+            max_retries=0,
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._default_hashes: List[int] = [
+            int(h, 16) for h in settings.avatar_default_hashes
+        ]
+
+    def process(self, url: str) -> Optional[Avatar]:
+        """
+        返回处理好的头像, 头像失效或是默认头像时返回None
+        """
+        if not url or is_default_avatar_url(url):
+            return None
+
+        content = self._fetch(url)
+        if not content:
+            return None
+
+        try:
+            image = Image.open(BytesIO(content))
+            image.load()
+        except Exception as err:
+            logger.error(f"avatar.decode url: {url}, err: {err}")
+            return None
+
+        if self._is_placeholder(image):
+            logger.debug(f"avatar.placeholder url: {url}")
+            return None
+
+        image = image.convert("RGB")
+        image.thumbnail((settings.avatar_max_size, settings.avatar_max_size))
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=85)
+        data = buffer.getvalue()
+
+        avatar = Avatar(url=url)
+        avatar.digest = hashlib.sha1(data).hexdigest()
+        avatar.data_url = (
+            f"data:image/jpeg;base64,{base64.b64encode(data).decode('ascii')}"
+        )
+        return avatar
+
+    def _fetch(self, url: str) -> bytes:
+        try:
+            response = self._session.get(
+                url, timeout=settings.avatar_timeout, stream=True
+            )
+            with response:
+                if response.status_code != 200:
+                    logger.debug(
+                        f"avatar.fetch url: {url}, status: {response.status_code}"
+                    )
+                    return b""
+                # 重定向到默认头像服务的也当成默认头像(如gravatar回落到auth0的首字母头像)
+                if is_default_avatar_url(response.url):
+                    return b""
+                content_type = response.headers.get("Content-Type", "")
+                if content_type and not content_type.startswith("image/"):
+                    return b""
+                content = response.raw.read(
+                    settings.avatar_max_bytes + 1, decode_content=True
+                )
+                if len(content) > settings.avatar_max_bytes:
+                    logger.debug(f"avatar.fetch.too_large url: {url}")
+                    return b""
+                return content
+        except Exception as err:
+            logger.error(f"avatar.fetch url: {url}, err: {err}")
+        return b""
+
+    def _is_placeholder(self, image: Image.Image) -> bool:
+        """
+        感知哈希接近已知的默认头像, 或者画面几乎只有两种颜色(纯色背景+首字母)时认为是占位头像
+        """
+        value = dhash(image)
+        for default_hash in self._default_hashes:
+            if bin(value ^ default_hash).count("1") <= settings.avatar_hash_distance:
+                return True
+
+        if settings.avatar_flat_color_ratio <= 0:
+            return False
+        return flat_color_ratio(image) >= settings.avatar_flat_color_ratio
+
+
+def flat_color_ratio(image: Image.Image) -> float:
+    """
+    缩略图里和两种主色(粗量化后最多的两种颜色的平均值)足够接近的像素占比
+    """
+    pixels = list(image.convert("RGB").resize((32, 32)).getdata())
+    coarse = Counter((r >> 5, g >> 5, b >> 5) for r, g, b in pixels)
+    centers = []
+    for key, _ in coarse.most_common(2):
+        members = [p for p in pixels if (p[0] >> 5, p[1] >> 5, p[2] >> 5) == key]
+        centers.append([sum(c) / len(members) for c in zip(*members)])
+    limit = settings.avatar_flat_color_distance**2
+    near = sum(
+        1
+        for p in pixels
+        if any(sum((a - b) ** 2 for a, b in zip(p, c)) <= limit for c in centers)
+    )
+    return near / len(pixels)
+
+
+def is_default_avatar_url(url: str) -> bool:
+    for pattern in DEFAULT_AVATAR_PATTERNS:
+        if pattern.search(url):
+            return True
+    return False
+
+
+def dhash(image: Image.Image, size: int = 8) -> int:
+    """
+    计算图片的difference hash, 用于识别相似的默认头像
+    """
+    gray = image.convert("L").resize((size + 1, size))
+    pixels = list(gray.getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+if __name__ == "__main__":
+    import sys
+
+    # 打印头像的dhash和双色占比, 用于配置AVATAR_DEFAULT_HASHES和AVATAR_FLAT_COLOR_RATIO
+    for source in sys.argv[1:]:
+        if source.startswith("http"):
+            data = requests.get(source, timeout=settings.avatar_timeout).content
+        else:
+            with open(source, "rb") as f:
+                data = f.read()
+        image = Image.open(BytesIO(data))
+        print(f"{dhash(image):016x} {flat_color_ratio(image):.3f} {source}")
@@ -0,0 +1,181 @@
+from typing import Deque, Dict, List
+from collections import deque
+from env import settings, logger
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# 熔断打开后的处理方式: 暂停等待恢复, 跳过这部分数据继续预测, 结束本次运行
+POLICY_PAUSE = "pause"
+POLICY_SKIP = "skip"
+POLICY_ABORT = "abort"
+
+
+class CircuitOpen(Exception):
+    def __init__(self, name: str):
+        super().__init__(f"circuit {name} is open")
+        self.name = name
+
+
+class CircuitBreaker(object):
+    """
+    一个外部依赖的熔断器:
+    - 最近settings.breaker_window次调用里失败率超过阈值时打开, 之后的调用直接失败
+    - 打开settings.breaker_open_seconds秒后进入半开状态, 只放行一次探测调用
+    - 探测成功则关闭, 失败则重新打开
+    """
+
+    def __init__(self, name: str, policy: str):
+        self.name = name
+        self.policy = policy
+        self.state = CLOSED
+        self.calls: int = 0
+        self.failures: int = 0
+        self.rejected: int = 0
+        self.opened: int = 0
+        self._opened_at: float = 0.0
+        self._probing = False
+        self._window: Deque[bool] = deque(maxlen=settings.breaker_window)
+        self._lock = threading.Lock()
+        # 当前线程里失败和被拒绝的次数, 不受后台写入线程的影响
+        self._local = threading.local()
+
+    def thread_failures(self) -> int:
+        return getattr(self._local, "failures", 0)
+
+    def _count_thread_failure(self):
+        self._local.failures = self.thread_failures() + 1
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == OPEN and time.time() >= self.retry_at():
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            if self.state == CLOSED:
+                return True
+            self.rejected += 1
+            self._count_thread_failure()
+            return False
+
+    def check(self):
+        """
+        熔断打开时抛出CircuitOpen
+        """
+        if not self.allow():
+            raise CircuitOpen(self.name)
+
+    def record_success(self):
+        with self._lock:
+            self.calls += 1
+            if self.state == HALF_OPEN:
+                logger.info(f"breaker.{self.name}.closed")
+                self.state = CLOSED
+                self._window.clear()
+            self._window.append(True)
+
+    def record_failure(self):
+        with self._lock:
+            self.calls += 1
+            self.failures += 1
+            self._count_thread_failure()
+            if self.state == HALF_OPEN:
+                self._open()
+                return
+            self._window.append(False)
+            if self.state == CLOSED and len(self._window) >= settings.breaker_min_calls:
+                failed = sum(1 for ok in self._window if not ok)
+                if failed >= settings.breaker_failure_rate * len(self._window):
+                    self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self.opened += 1
+        self._opened_at = time.time()
+        self._probing = False
+        self._window.clear()
+        logger.warn(
+            f"breaker.{self.name}.open policy: {self.policy}, retry in {settings.breaker_open_seconds}s"
+        )
+
+    def retry_at(self) -> float:
+        return self._opened_at + settings.breaker_open_seconds
+
+    def is_open(self) -> bool:
+        with self._lock:
+            return self.state == OPEN and time.time() < self.retry_at()
+
+    def to_data(self) -> Dict[str, int | str]:
+        with self._lock:
+            return {
+                "state": self.state,
+                "calls": self.calls,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "opened": self.opened,
+            }
+
+
+class Breakers(object):
+    """
+    bigquery, pinecone, openai各自的熔断器, 以及按策略决定运行要不要暂停或结束
+    """
+
+    def __init__(self, names: List[str]):
+        self._breakers: Dict[str, CircuitBreaker] = {
+            name: CircuitBreaker(
+                name=name,
+                policy=settings.breaker_policies.get(name, POLICY_PAUSE),
+            )
+            for name in names
+        }
+        self.paused_seconds: float = 0.0
+
+    def __getitem__(self, name: str) -> CircuitBreaker:
+        return self._breakers[name]
+
+    def required(self) -> List[CircuitBreaker]:
+        """
+        策略不是skip的依赖, 它们失败时这次的预测结果不完整
+        """
+        return [b for b in self._breakers.values() if b.policy != POLICY_SKIP]
+
+    def failures(self) -> int:
+        """
+        当前线程里必需依赖累计的失败和被熔断拒绝的调用次数, 前后对比可以知道一次预测有没有受影响
+        """
+        return sum(b.thread_failures() for b in self.required())
+
+    def wait(self, stopping=lambda: False) -> bool:
+        """
+        有必需依赖处于熔断状态时, 按策略暂停到可以探测为止; 需要结束运行时返回False
+        """
+        for breaker in self.required():
+            if not breaker.is_open():
+                continue
+            if breaker.policy == POLICY_ABORT:
+                logger.error(f"breaker.{breaker.name}.abort")
+                return False
+            seconds = breaker.retry_at() - time.time()
+            if self.paused_seconds + seconds > settings.breaker_max_pause:
+                logger.error(
+                    f"breaker.{breaker.name}.abort paused: {int(self.paused_seconds)}s"
+                )
+                return False
+            logger.warn(f"breaker.{breaker.name}.pause {seconds:.1f}s")
+            start = time.time()
+            while time.time() < breaker.retry_at() and not stopping():
+                time.sleep(min(1.0, max(0.0, breaker.retry_at() - time.time())))
+            self.paused_seconds += time.time() - start
+        return True
+
+    def to_data(self) -> Dict[str, dict]:
+        return {name: b.to_data() for name, b in self._breakers.items()}
+
+
+breakers = Breakers(names=["bigquery", "pinecone", "openai"])
@@ -0,0 +1,113 @@
+from typing import Dict, List, Tuple
+from env import settings
+import hashlib
+import random
+import re
+
+_DIGITS = re.compile(r"\d+")
+_SPACES = re.compile(r"\s+")
+# 中日韩文字(汉字, 假名, 谚文), 词之间没有空格, 按更短的字数切分
+_CJK = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]+")
+
+# 2^61 - 1, 每个排列是一个独立随机的 (a * x + b) mod p, 同一进程内外结果都一致
+_PRIME = (1 << 61) - 1
+_PERMUTATIONS: List[Tuple[int, int]] = [
+    (random.Random(i).randrange(1, _PRIME), random.Random(-i - 1).randrange(_PRIME))
+    for i in range(settings.near_dup_num_perm)
+]
+
+
+def normalize(text: str) -> str:
+    """
+    小写, 合并空白, 数字统一成0, 让只有数字不同的模板prompt完全一致
+    """
+    text = _DIGITS.sub("0", text.lower())
+    return _SPACES.sub(" ", text).strip()
+
+
+def _grams(segment: str, size: int) -> List[str]:
+    segment = segment.strip()
+    if not segment:
+        return []
+    if len(segment) <= size:
+        return [segment]
+    return [segment[i : i + size] for i in range(len(segment) - size + 1)]
+
+
+def shingles(text: str) -> List[int]:
+    """
+    字符级的shingle: 中日韩文字按settings.near_dup_cjk_shingle_size个字, 其他文字按settings.near_dup_shingle_size个字符
+    每个shingle用blake2b取64位哈希
+    """
+    grams = set()
+    pos = 0
+    for match in _CJK.finditer(text):
+        grams.update(_grams(text[pos : match.start()], settings.near_dup_shingle_size))
+        grams.update(_grams(match.group(), settings.near_dup_cjk_shingle_size))
+        pos = match.end()
+    grams.update(_grams(text[pos:], settings.near_dup_shingle_size))
+    if not grams:
+        grams.add(text)
+    return [
+        int.from_bytes(
+            hashlib.blake2b(g.encode("utf-8"), digest_size=8).digest(), "big"
+        )
+        for g in grams
+    ]
+
+
+def minhash(text: str) -> Tuple[int, ...]:
+    hashes = shingles(normalize(text))
+    return tuple(min((a * x + b) % _PRIME for x in hashes) for a, b in _PERMUTATIONS)
+
+
+def similarity(a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+    """
+    两个签名相同位置相等的比例, 即Jaccard相似度的估计
+    """
+    return sum(1 for x, y in zip(a, b) if x == y) / len(a)
+
+
+def collapse_prompts(prompts: List[str]) -> List[Tuple[str, int]]:
+    """
+    用MinHash + LSH分桶把近似重复的prompt聚成一类, 返回每类的代表(第一次出现的prompt)和数量, 保持原有顺序
+    每条prompt只和同桶里的代表比较, 对每个用户是线性时间
+    """
+    rows = settings.near_dup_num_perm // settings.near_dup_bands
+    buckets: Dict[Tuple[int, Tuple[int, ...]], List[int]] = {}
+    exact: Dict[str, int] = {}
+    signatures: List[Tuple[int, ...]] = []
+    clusters: List[Tuple[str, int]] = []
+    for prompt in prompts:
+        if prompt in exact:
+            index = exact[prompt]
+            clusters[index] = (clusters[index][0], clusters[index][1] + 1)
+            continue
+        signature = minhash(prompt)
+        keys = [
+            (band, signature[band * rows : (band + 1) * rows])
+            for band in range(settings.near_dup_bands)
+        ]
+        found = -1
+        for key in keys:
+            for index in buckets.get(key, []):
+                if (
+                    similarity(signature, signatures[index])
+                    >= settings.near_dup_threshold
+                ):
+                    found = index
+                    break
+            if found >= 0:
+                break
+        if found >= 0:
+            exact[prompt] = found
+            clusters[found] = (clusters[found][0], clusters[found][1] + 1)
+            continue
+
+        index = len(clusters)
+        exact[prompt] = index
+        signatures.append(signature)
+        clusters.append((prompt, 1))
+        for key in keys:
+            buckets.setdefault(key, []).append(index)
+    return clusters
@@ -1,4 +1,5 @@
 from dotenv import load_dotenv
+from typing import Dict, List, Tuple
 import os
 
 
@@ -9,9 +10,137 @@ class Settings(object):
         self.pinecone_api_key = os.getenv("PINECONE_API_KEY")
         self.pinecone_namespace = os.getenv("PINECONE_NAMESPACE")
         self.pinecone_index_host = os.getenv("PINECONE_INDEX_HOST")
+        # 每次查询前先dry run一次, 记录预计扫描的字节数
+        self.bigquery_dry_run: bool = os.getenv("BIGQUERY_DRY_RUN") == "1"
         self.is_test: bool = os.getenv("ENVIRONMENT") != "cloud"  # type: ignore
         self.predict_confidence_threshold: float = 0.6
+        # 预测用的模型, prompt里用户历史prompt的token预算(<= 0 表示不限制), 输出格式约束
+        self.llm_model: str = "gpt-4.1"
+        self.vision_model: str = "gpt-4.1"
+        self.prompt_budget: int = 0
+        self.schema_mode: str = "none"
+        # 每百万token的价格(美元): 模型 -> (输入, 输出)
+        self.model_prices: Dict[str, Tuple[float, float]] = {
+            "gpt-4.1": (2.0, 8.0),
+            "gpt-4.1-mini": (0.4, 1.6),
+            "gpt-4.1-nano": (0.1, 0.4),
+            "gpt-4o": (2.5, 10.0),
+            "gpt-4o-mini": (0.15, 0.6),
+        }
         self.min_task_count: int = 10
+        # 每个用户最多取最近的多少条不重复prompt, <= 0 表示不限制
+        self.max_task_prompts: int = 1000
+        # 每个用户最多取最近上传的多少个不重复文件名
+        self.max_user_files: int = 20
+        # 批量查询时每批的user_id个数
+        self.bulk_chunk_size: int = 500
+        # 头像预处理: 拉取超时(秒), 最大字节数, 缩放后的最大边长, 连接池大小
+        self.avatar_timeout: float = 3.0
+        self.avatar_max_bytes: int = 5 * 1024 * 1024
+        self.avatar_max_size: int = 512
+        self.avatar_pool_size: int = 16
+        # 已知默认头像的dhash(16进制, 逗号分隔), 汉明距离不超过avatar_hash_distance的都当成默认头像
+        # 可以用 python avatar.py <url或文件> 计算; 首字母头像随字母和颜色变化, 由下面的双色检测识别
+        self.avatar_default_hashes: List[str] = [
+            h.strip()
+            for h in os.getenv("AVATAR_DEFAULT_HASHES", "").split(",")
+            if h.strip()
+        ]
+        self.avatar_hash_distance: int = 5
+        # 缩略图里和两种主色接近的像素占比超过这个比例时认为是首字母一类的占位头像, <= 0 表示不检测
+        # 纯色背景+白色首字母的头像在0.93以上, 有渐变和纹理的照片远低于这个值; 双色的logo和卡通头像会被误伤
+        self.avatar_flat_color_ratio: float = float(
+            os.getenv("AVATAR_FLAT_COLOR_RATIO", "0.9")
+        )
+        # 和主色的RGB距离在这个范围内的像素都算作主色, 容忍首字母边缘的抗锯齿
+        self.avatar_flat_color_distance: int = 48
+        # 每次vision请求最多合并多少张没有缓存的头像, <= 1 表示逐个调用
+        self.avatar_batch_size: int = 8
+        # 每处理多少个用户提前批量描述一次接下来这些用户的头像
+        self.avatar_prefetch: int = 64
+        # 本地预测结果库的目录, 为空时不写入
+        self.result_store_path: str = os.getenv("RESULT_STORE_PATH", "")
+        # 每累计多少条结果写一次结果库
+        self.result_store_flush: int = 500
+        # 只同步和上一次结果相比有变化的用户和字段, SINK_WRITE_ALL=1 时全部同步
+        self.sink_changes_only: bool = os.getenv("SINK_WRITE_ALL") != "1"
+        # 同步mixpanel/bigquery的异步写入: 每个目标的worker数(0表示同步写), 队列长度, 退出时最多等待的秒数
+        self.sink_workers: int = 4
+        self.sink_queue_size: int = 1000
+        self.sink_drain_timeout: float = 8.0
+        # 熔断: 最近breaker_window次调用里至少breaker_min_calls次且失败率达到breaker_failure_rate时打开,
+        # breaker_open_seconds秒后放行一次探测; 一次运行里因为熔断累计暂停超过breaker_max_pause秒时结束运行
+        self.breaker_window: int = 20
+        self.breaker_min_calls: int = 5
+        self.breaker_failure_rate: float = 0.5
+        self.breaker_open_seconds: float = 30.0
+        self.breaker_max_pause: float = 600.0
+        # 每个依赖熔断时的策略(pause/skip/abort), 可以用 BREAKER_POLICY=openai=abort,bigquery=pause 覆盖
+        self.breaker_policies: Dict[str, str] = {
+            "bigquery": "pause",
+            "pinecone": "skip",
+            "openai": "pause",
+        }
+        for item in os.getenv("BREAKER_POLICY", "").split(","):
+            if "=" in item:
+                name, policy = item.split("=", 1)
+                self.breaker_policies[name.strip()] = policy.strip()
+        # 预测时必需依赖失败过的用户最多重试几次, 仍然失败时不同步结果
+        self.breaker_user_retries: int = 1
+        # LLM请求对冲: 请求超过llm_hedge_delay秒(<= 0 时用最近llm_hedge_window次请求耗时的p95)
+        # 还没返回时再发一次相同请求, 对冲次数不超过总请求数的llm_hedge_max_ratio
+        self.llm_hedge_enabled: bool = os.getenv("LLM_HEDGE") == "1"
+        self.llm_hedge_delay: float = 0.0
+        self.llm_hedge_percentile: float = 0.95
+        self.llm_hedge_window: int = 200
+        self.llm_hedge_min_samples: int = 20
+        self.llm_hedge_max_ratio: float = 0.05
+        self.llm_hedge_workers: int = 8
+        # 单次运行的LLM预算, <= 0 表示不限制: 超过soft后换成更便宜的budget_variant, 超过hard后停止运行
+        self.budget_soft_cost: float = float(os.getenv("BUDGET_SOFT_COST", "0"))
+        self.budget_hard_cost: float = float(os.getenv("BUDGET_HARD_COST", "0"))
+        self.budget_soft_tokens: int = int(os.getenv("BUDGET_SOFT_TOKENS", "0"))
+        self.budget_hard_tokens: int = int(os.getenv("BUDGET_HARD_TOKENS", "0"))
+        self.budget_variant: Dict[str, str | int | bool] = {
+            "name": "budget",
+            "model": "gpt-4.1-mini",
+            "use_avatar": False,
+            "prompt_budget": 4000,
+        }
+        # 运行被预算或者信号中止时, 把停止的位置写到这个json文件里, 为空时只打日志
+        self.run_state_path: str = os.getenv("RUN_STATE_PATH", "")
+        # 合并预测: 输入不超过pack_user_tokens的小用户攒到pack_max_users个或者pack_max_tokens后合成一次请求
+        self.pack_enabled: bool = os.getenv("LLM_PACK") == "1"
+        self.pack_user_tokens: int = 1500
+        self.pack_max_users: int = 8
+        self.pack_max_tokens: int = 8000
+        # 重度用户历史prompt的滚动摘要, SUMMARY_STORE_PATH为空时不使用:
+        # 不重复prompt达到summary_min_prompts条的用户, 只发送摘要和水位线之后的新prompt,
+        # 新prompt累计到summary_refresh_prompts条时把它们合并进摘要; 始终保留最近summary_recent_prompts条原始prompt
+        self.summary_store_path: str = os.getenv("SUMMARY_STORE_PATH", "")
+        self.summary_model: str = "gpt-4.1-mini"
+        self.summary_min_prompts: int = 300
+        self.summary_refresh_prompts: int = 200
+        self.summary_recent_prompts: int = 50
+        self.summary_chunk_tokens: int = 8000
+        self.summary_max_words: int = 400
+        # 用MinHash + LSH合并近似重复的prompt(只有数字不同的模板, 小改动), 每类只保留一条并标出数量
+        # near_dup_num_perm个排列分成near_dup_bands段, 签名估计的相似度达到near_dup_threshold时认为重复
+        # 会丢掉原始prompt的细节, 在用evaluate.py评估之前默认不开启, NEAR_DUP_ENABLED=1 时开启
+        self.near_dup_enabled: bool = os.getenv("NEAR_DUP_ENABLED") == "1"
+        self.near_dup_num_perm: int = 64
+        self.near_dup_bands: int = 16
+        self.near_dup_threshold: float = 0.7
+        # 中日韩文字按near_dup_cjk_shingle_size个字切分, 其他文字按near_dup_shingle_size个字符切分
+        self.near_dup_shingle_size: int = 5
+        self.near_dup_cjk_shingle_size: int = 2
+        # 运行开始时把用户数据导出到本地duckdb快照, 之后按user_id在本地查询
+        self.snapshot_enabled: bool = os.getenv("SNAPSHOT_DISABLED") != "1"
+        self.snapshot_path: str = os.getenv(
+            "SNAPSHOT_PATH", "/tmp/user_insight_snapshot.duckdb"
+        )
+        # 运行结束后是否保留快照文件
+        self.snapshot_keep: bool = os.getenv("SNAPSHOT_KEEP") == "1"
 
     @property
     def version(self) -> int:
@@ -0,0 +1,259 @@
+from env import logger
+from typing import Dict, List, Optional
+from schemas import UserInputs, Variant, predict_properties
+from main import UserInsight
+from metrics import Usage, percentile
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import csv
+import json
+import re
+import time
+
+# 人工标注里可以识别的属性值: 属性 -> {标注写法(小写): 和预测结果对比的值}
+# 只接受整段标注正好是这些写法之一, 不做子串匹配, 例如 "做語文英語作業" 不会被当成english
+LABEL_VALUES: Dict[str, Dict[str, str]] = {
+    "occupation": {
+        **dict.fromkeys(
+            ["学生", "學生", "大学生", "大學生", "研究生", "student"], "student"
+        ),
+        **dict.fromkeys(["老师", "老師", "教师", "教師", "teacher"], "teacher"),
+        **dict.fromkeys(["设计师", "設計師", "designer"], "designer"),
+        **dict.fromkeys(
+            [
+                "工程师",
+                "工程師",
+                "程序员",
+                "程序員",
+                "engineer",
+                "developer",
+                "tech engineer",
+            ],
+            "tech engineer",
+        ),
+        **dict.fromkeys(
+            ["数据分析", "數據分析", "data analysis", "data analyst"], "data analysis"
+        ),
+        **dict.fromkeys(
+            ["医生", "醫生", "护士", "護士", "doctor", "nurse", "healthcare"],
+            "healthcare",
+        ),
+        **dict.fromkeys(["营销", "營銷", "市场营销", "marketing"], "marketing"),
+    },
+    "gender": {
+        **dict.fromkeys(["女", "女性", "female", "f", "girl", "woman"], "female"),
+        **dict.fromkeys(["男", "男性", "male", "m", "boy", "man"], "male"),
+    },
+    "primary_language": {
+        **dict.fromkeys(
+            ["繁体中文", "繁體中文", "繁体", "繁體", "traditional chinese"],
+            "traditional chinese",
+        ),
+        **dict.fromkeys(
+            ["简体中文", "簡體中文", "简体", "簡體", "simplified chinese"],
+            "simplified chinese",
+        ),
+        **dict.fromkeys(["韩语", "韓語", "korean"], "korean"),
+        **dict.fromkeys(["俄语", "俄語", "russian"], "russian"),
+        **dict.fromkeys(["英文", "英语", "英語", "english"], "english"),
+        **dict.fromkeys(["粤语", "粵語", "cantonese"], "cantonese"),
+    },
+}
+
+# 标注里分隔多个属性的符号
+_SEPARATORS = re.compile(r"[,，;；/|、\n]+")
+
+
+def parse_label(text: str) -> Dict[str, str]:
+    """
+    从一条人工标注里提取各个属性的期望值:
+    - 按逗号等分隔成若干段, 每段去掉 "性别:" 一类的前缀后必须正好是LABEL_VALUES里的一种写法
+    - 带问号的段是标注人不确定的, 跳过
+    - 同一个属性出现不同的值时这个属性不算标注
+    无法识别的标注返回空dict, 当成没有标注
+    """
+    found: Dict[str, set] = {}
+    for part in _SEPARATORS.split(text or ""):
+        part = re.split(r"[:：]", part)[-1].strip().lower()
+        if not part or part.endswith(("?", "？")):
+            continue
+        for attribute, values in LABEL_VALUES.items():
+            if part in values:
+                found.setdefault(attribute, set()).add(values[part])
+    return {k: v.pop() for k, v in found.items() if len(v) == 1}
+
+
+def predicted_value(row: dict, attribute: str) -> str:
+    """
+    预测值转成和mixpanel上一致的小写形式(zh-cn等语言代码转成名称), 和期望值做完全相等的比较
+    """
+    value = predict_properties(row).get(f"predict_{attribute}", "").strip()
+    return value or "unknown"
+
+
+def load_labels(path: str) -> Dict[int, Dict[str, str]]:
+    """
+    读取带人工标注predict列的merge.csv, 返回 user_id -> 属性期望值
+    """
+    labels: Dict[int, Dict[str, str]] = {}
+    unlabelled = 0
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            try:
+                user_id = int(row.get("user_id", ""))
+            except ValueError:
+                continue
+            expected = parse_label(row.get("predict") or "")
+            if expected:
+                labels[user_id] = expected
+            else:
+                unlabelled += 1
+    logger.info(
+        f"evaluate.labels labelled: {len(labels)}, unlabelled: {unlabelled}, path: {path}"
+    )
+    return labels
+
+
+def record_inputs(insight: UserInsight, user_ids: List[int], output: str):
+    """
+    把标注用户的预测输入录制到jsonl, 之后各个variant都用同一份输入评估
+    只读取已有的历史摘要, 录制时不生成也不写入摘要
+    """
+    insight.summary_writes = False
+    count = 0
+    with open(output, "w", encoding="utf-8") as f:
+        for user_id in user_ids:
+            inputs = insight.load_inputs(user_id=user_id)
+            if inputs is None:
+                logger.info(f"evaluate.record.skip user_id: {user_id}")
+                continue
+            f.write(json.dumps(inputs.to_data(), ensure_ascii=False, default=str))
+            f.write("\n")
+            count += 1
+    logger.info(f"evaluate.record count: {count}/{len(user_ids)}, output: {output}")
+
+
+def load_recorded_inputs(path: str) -> List[UserInputs]:
+    recorded: List[UserInputs] = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            d = json.loads(line)
+            inputs = UserInputs(user_id=d["user_id"])
+            inputs.load_from_data(d)
+            recorded.append(inputs)
+    return recorded
+
+
+def load_variants(path: Optional[str]) -> List[Variant]:
+    if not path:
+        return [Variant()]
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    variants: List[Variant] = []
+    for d in data:
+        variant = Variant(name=d.get("name", f"variant_{len(variants)}"))
+        variant.load_from_data(d)
+        variants.append(variant)
+    return variants
+
+
+def evaluate_variant(
+    insight: UserInsight,
+    variant: Variant,
+    recorded: List[UserInputs],
+    labels: Dict[int, Dict[str, str]],
+    workers: int = 4,
+) -> dict:
+    """
+    用一个variant跑完所有录制的输入, 统计每个属性的准确率和每个用户的token, 延迟, 花费
+    """
+    insight.usage = Usage()
+
+    def predict(inputs: UserInputs):
+        start = time.time()
+        user_predict = insight.predict_inputs(inputs=inputs, variant=variant)
+        return inputs.user_id, user_predict, time.time() - start
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(predict, recorded))
+
+    correct: Dict[str, int] = {k: 0 for k in LABEL_VALUES}
+    labelled: Dict[str, int] = {k: 0 for k in LABEL_VALUES}
+    latencies: List[float] = []
+    failures = 0
+    for user_id, user_predict, latency in results:
+        latencies.append(latency)
+        if user_predict is None:
+            failures += 1
+        row = user_predict.row_data() if user_predict else {}
+        for attribute, value in labels.get(user_id, {}).items():
+            labelled[attribute] += 1
+            if predicted_value(row, attribute) == value:
+                correct[attribute] += 1
+
+    users = max(len(recorded), 1)
+    usage = insight.usage.to_data()
+    return {
+        "variant": variant.name,
+        "model": variant.model,
+        "prompt_budget": variant.prompt_budget,
+        "use_avatar": variant.use_avatar,
+        "schema_mode": variant.schema_mode,
+        "users": len(recorded),
+        "failures": failures,
+        "accuracy": {
+            k: round(correct[k] / labelled[k], 4) if labelled[k] else None
+            for k in LABEL_VALUES
+        },
+        "labelled": labelled,
+        "unlabelled": sum(1 for inputs in recorded if inputs.user_id not in labels),
+        "input_tokens_per_user": round(usage["input_tokens"] / users, 1),
+        "output_tokens_per_user": round(usage["output_tokens"] / users, 1),
+        "cost_per_user": round(usage["cost"] / users, 6),
+        "latency_avg": round(sum(latencies) / users, 3),
+        "latency_p95": round(percentile(latencies, 0.95), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="offline accuracy vs cost evaluation of UserInsight variants"
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    record = sub.add_parser("record", help="record prediction inputs of labelled users")
+    record.add_argument("--labels", default="../scripts/merge/merge.csv")
+    record.add_argument("--output", default="eval_inputs.jsonl")
+
+    run = sub.add_parser("run", help="evaluate variants on recorded inputs")
+    run.add_argument("--labels", default="../scripts/merge/merge.csv")
+    run.add_argument("--inputs", default="eval_inputs.jsonl")
+    run.add_argument(
+        "--variants",
+        default="",
+        help="json file with a list of {name, model, prompt_budget, use_avatar, schema_mode}",
+    )
+    run.add_argument("--workers", type=int, default=4)
+    run.add_argument("--output", default="eval_report.json")
+    args = parser.parse_args()
+
+    insight = UserInsight()
+    labels = load_labels(args.labels)
+    if args.command == "record":
+        record_inputs(insight, sorted(labels.keys()), args.output)
+        return
+
+    recorded = load_recorded_inputs(args.inputs)
+    reports = []
+    for variant in load_variants(args.variants):
+        report = evaluate_variant(insight, variant, recorded, labels, args.workers)
+        logger.info(f"evaluate.report {json.dumps(report, ensure_ascii=False)}")
+        reports.append(report)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(reports, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+from typing import Callable, Deque, Dict, Optional, TypeVar
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from env import settings, logger
+from metrics import percentile
+import threading
+import time
+
+T = TypeVar("T")
+
+
+class Hedger(object):
+    """
+    对长尾的LLM请求做对冲:
+    请求超过延迟阈值(默认是观测到的p95)还没有返回时再发一个相同的请求, 用先返回的结果
+    对冲请求数不超过总请求数的settings.llm_hedge_max_ratio, 被丢弃的请求的用量照常记录
+    """
+
+    def __init__(self):
+        self.calls: int = 0
+        self.hedged: int = 0
+        self.hedge_wins: int = 0
+        self._latencies: Deque[float] = deque(maxlen=settings.llm_hedge_window)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=settings.llm_hedge_workers, thread_name_prefix="llm-hedge"
+        )
+
+    def delay(self) -> Optional[float]:
+        """
+        发起对冲请求前等待的秒数, 观测样本不够时返回None, 不做对冲
+        """
+        if settings.llm_hedge_delay > 0:
+            return settings.llm_hedge_delay
+        with self._lock:
+            if len(self._latencies) < settings.llm_hedge_min_samples:
+                return None
+            return percentile(list(self._latencies), settings.llm_hedge_percentile)
+
+    def call(self, fn: Callable[[], T]) -> T:
+        with self._lock:
+            self.calls += 1
+        if not settings.llm_hedge_enabled:
+            return fn()
+
+        primary = self._submit(fn)
+        delay = self.delay()
+        if delay is None:
+            return primary.result()
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._allow_hedge():
+            return primary.result()
+
+        logger.debug(f"llm.hedge after {delay:.2f}s")
+        hedge = self._submit(fn)
+        pending = {primary, hedge}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                if future is hedge:
+                    with self._lock:
+                        self.hedge_wins += 1
+                return future.result()
+        raise error  # type: ignore
+
+    def _submit(self, fn: Callable[[], T]) -> "Future[T]":
+        start = time.time()
+        future = self._executor.submit(fn)
+        future.add_done_callback(lambda _: self._record_latency(time.time() - start))
+        return future
+
+    def _record_latency(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def _allow_hedge(self) -> bool:
+        with self._lock:
+            if self.hedged + 1 > settings.llm_hedge_max_ratio * self.calls:
+                return False
+            self.hedged += 1
+            return True
+
+    def to_data(self) -> Dict[str, float]:
+        delay = self.delay()
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "delay": round(delay, 3) if delay is not None else -1,
+            }
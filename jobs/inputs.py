@@ -1,14 +1,57 @@
 from google.cloud import bigquery
-from typing import List, Dict, Optional
+from datetime import datetime
+from typing import List, Dict, Optional, Set, Tuple
 from env import settings, logger
-from schemas import UserModel, UserProperty
-import json
+from schemas import UserModel, UserProperty, UserFile, UserPrompt
+from snapshot import Snapshot
+from utils import chunks
+from breaker import breakers, CircuitOpen
 from pinecone import Pinecone as PineconeClient
 
 
+class QueryStats(object):
+    def __init__(self, tag: str):
+        self.tag: str = tag
+        self.calls: int = 0
+        self.errors: int = 0
+        self.cache_hits: int = 0
+        self.bytes_processed: int = 0
+        self.bytes_estimated: int = 0
+        self.slot_millis: int = 0
+
+    def record(self, job: bigquery.QueryJob):
+        self.calls += 1
+        if job.cache_hit:
+            self.cache_hits += 1
+        self.bytes_processed += job.total_bytes_processed or 0
+        self.slot_millis += job.slot_millis or 0
+
+
+QueryParams = List[bigquery.ScalarQueryParameter | bigquery.ArrayQueryParameter]
+
+
+def query_param(name: str, value) -> bigquery.ScalarQueryParameter:
+    """
+    根据python类型构造bigquery的查询参数
+    """
+    if isinstance(value, bool):
+        return bigquery.ScalarQueryParameter(name, "BOOL", value)
+    if isinstance(value, int):
+        return bigquery.ScalarQueryParameter(name, "INT64", value)
+    if isinstance(value, float):
+        return bigquery.ScalarQueryParameter(name, "FLOAT64", value)
+    return bigquery.ScalarQueryParameter(name, "STRING", value)
+
+
 class BigQuery(object):
     def __init__(self):
         self._client = bigquery.Client()
+        self._stats: Dict[str, QueryStats] = {}
+        self._snapshot: Optional[Snapshot] = None
+        self._mixpanel_users: Dict[int, UserProperty] = {}
+        self._mixpanel_loaded: Set[int] = set()
+        # mixpanel视图里的(属性列, 排序用的时间列), 第一次查询时从表结构读取
+        self._mixpanel_columns: Optional[Tuple[str, str]] = None
 
     @property
     def project_id(self) -> str:
@@ -23,14 +66,80 @@ class BigQuery(object):
     def user_insight_table(self) -> str:
         return f"{self.project_id}.insight.user_predict"
 
-    def _invoke(self, user_id: int, query: str, tag=""):
+    def _invoke(
+        self,
+        user_id: int,
+        query: str,
+        tag="",
+        params: Optional[QueryParams] = None,
+        strict: bool = False,
+    ):
+        """
+        执行查询并按tag记录扫描字节数/缓存命中/slot时间
+        params会以QueryJobConfig参数的形式传入, 查询文本不变时可以复用bigquery的结果缓存
+        strict为True时查询失败直接抛出异常, 否则记录错误后返回[]
+        """
+        tag = tag or "invoke"
+        stats = self._stats.setdefault(tag, QueryStats(tag=tag))
+        breaker = breakers["bigquery"]
+        if not breaker.allow():
+            stats.errors += 1
+            if strict:
+                raise CircuitOpen(breaker.name)
+            return []
+        if settings.bigquery_dry_run:
+            self.estimate(query=query, tag=tag, params=params)
         try:
-            job = self._client.query(query)
-            return job.result()
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=params or [], use_query_cache=True
+            )
+            job = self._client.query(query, job_config=job_config)
+            results = job.result()
+            stats.record(job)
+            breaker.record_success()
+            return results
         except Exception as err:
-            logger.error(f"bigquery.{tag or 'invoke'} user_id: {user_id}, err: {err}")
+            stats.errors += 1
+            breaker.record_failure()
+            logger.error(f"bigquery.{tag} user_id: {user_id}, err: {err}")
+            if strict:
+                raise
         return []
 
+    def estimate(
+        self,
+        query: str,
+        tag="",
+        params: Optional[QueryParams] = None,
+    ) -> int:
+        """
+        dry run查询, 返回预计扫描的字节数, 失败时返回-1
+        """
+        tag = tag or "invoke"
+        stats = self._stats.setdefault(tag, QueryStats(tag=tag))
+        try:
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=params or [], dry_run=True, use_query_cache=False
+            )
+            job = self._client.query(query, job_config=job_config)
+            estimated = job.total_bytes_processed or 0
+            stats.bytes_estimated += estimated
+            logger.debug(f"bigquery.{tag}.estimate bytes: {estimated}")
+            return estimated
+        except Exception as err:
+            logger.error(f"bigquery.{tag}.estimate err: {err}")
+        return -1
+
+    def stats(self) -> Dict[str, QueryStats]:
+        return self._stats
+
+    def log_stats(self):
+        """
+        输出每个tag的查询次数, 扫描字节数, 缓存命中和slot时间
+        """
+        for tag, stats in self._stats.items():
+            logger.info(f"bigquery.stats {tag} {stats.__dict__}")
+
     def load_user_ids(self) -> List[int]:
         """
         获取需要分析的user_id列表, 满足以下条件:
@@ -60,7 +169,7 @@ class BigQuery(object):
         )
         """
 
-        results = self._invoke(user_id=0, query=query, tag="load_user_ids")
+        results = self._invoke(user_id=0, query=query, tag="load_user_ids", strict=True)
 
         user_ids = []
         for row in results:
@@ -71,18 +180,16 @@ class BigQuery(object):
         return user_ids
 
     # 根据user_id和version作为联合索引去更新数据
-    def upsert_user_predict(self, version: int, row_data: Dict[str, str | int]):
+    def upsert_user_predict(
+        self, version: int, row_data: Dict[str, str | int], strict: bool = False
+    ):
         """
         把预测分析的结果加上版本保存到bigquery里备份
         """
         row_data["version"] = version
-        # 构建 SELECT 部分
-        select_clause = ", ".join(
-            [
-                f"{repr(v)} AS {k}" if isinstance(v, str) else f"{v} AS {k}"
-                for k, v in row_data.items()
-            ]
-        )
+        # 构建 SELECT 部分, 值都以查询参数传入
+        select_clause = ", ".join([f"@{k} AS {k}" for k in row_data])
+        params = [query_param(k, v) for k, v in row_data.items()]
 
         # 构建 SET 子句（排除主键）
         set_clause = ", ".join(
@@ -103,129 +210,384 @@ class BigQuery(object):
           INSERT ({columns}) VALUES ({values})
         """
 
-        self._invoke(user_id=0, query=query, tag="upsert_user_predict")
+        self._invoke(
+            user_id=row_data.get("user_id", 0),
+            query=query,
+            tag="upsert_user_predict",
+            params=params,
+            strict=strict,
+        )
 
-    def load_user_profile(self, user_id: int) -> Optional[UserModel]:
+    def load_users_predict(self, user_ids: List[int]) -> Dict[int, dict]:
         """
-        通过bigquery从kuse_ai项目的mysql数据库user表里查询用户信息
+        批量查询这些用户在user_predict表里最新version的一行结果
         """
+        rows: Dict[int, dict] = {}
+        if not user_ids:
+            return rows
         query = f"""
-        SELECT * FROM EXTERNAL_QUERY(
-          "{self.kuse_ai_table()}",
-          \"""
-            SELECT
-              u.id,
-              u.email,
-              u.given_name,
-              u.family_name,
-              u.image_url,
-              u.output_language,
-              u.full_name
-            FROM user AS u
-            WHERE id = {user_id}
-          \"""
+        SELECT *
+        FROM `{self.user_insight_table()}`
+        WHERE user_id IN UNNEST(@user_ids)
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY version DESC) = 1
+        """
+        results = self._invoke(
+            user_id=user_ids[0] if len(user_ids) == 1 else 0,
+            query=query,
+            tag="load_users_predict",
+            params=[
+                bigquery.ArrayQueryParameter(
+                    "user_ids", "INT64", [int(user_id) for user_id in user_ids]
+                )
+            ],
         )
+        for row in results:
+            rows[int(row["user_id"])] = dict(row.items())
+        return rows
+
+    def build_snapshot(self, user_ids: List[int]):
+        """
+        运行开始时把这些用户在user/tasks/files表里的数据批量导出到本地快照
+        之后的load_user_*都优先从快照里读
+        某一批导出失败时不标记这批用户, 它们之后回退到按用户查询
         """
+        if self._snapshot is not None:
+            self._snapshot.close()
+        snapshot = Snapshot(path=settings.snapshot_path)
+        for chunk in chunks(user_ids, settings.bulk_chunk_size):
+            try:
+                profiles = self.load_users_profiles(user_ids=chunk, strict=True)
+                prompts = self.load_users_prompts(user_ids=chunk, strict=True)
+                files = self.load_users_files(user_ids=chunk, strict=True)
+            except Exception as err:
+                logger.error(
+                    f"bigquery.build_snapshot chunk: {len(chunk)} users, err: {err}"
+                )
+                continue
+            snapshot.add_profiles(profiles)
+            snapshot.add_prompts(prompts)
+            snapshot.add_files(files)
+            snapshot.mark_loaded(chunk)
+        snapshot.build_index()
+        self._snapshot = snapshot
+
+    def in_snapshot(self, user_id: int) -> bool:
+        return self._snapshot is not None and self._snapshot.contains(user_id)
+
+    def close_snapshot(self):
+        if self._snapshot is None:
+            return
+        self._snapshot.close()
+        self._snapshot = None
 
-        results = self._invoke(user_id=user_id, query=query, tag="load_user_profile")
-        for row in results:
-            model = UserModel(user_id=row[0])
-            model.__dict__.update(
-                {
-                    "email": row[1],
-                    "given_name": row[2],
-                    "family_name": row[3],
-                    "image_url": row[4],
-                    "output_language": row[5],
-                    "full_name": row[6],
-                }
+    def load_user_profile(self, user_id: int) -> Optional[UserModel]:
+        """
+        通过bigquery从kuse_ai项目的mysql数据库user表里查询用户信息
+        """
+        if self._snapshot is not None and self._snapshot.contains(user_id):
+            return self._snapshot.load_user_profile(user_id=user_id)
+        return self.load_users_profiles(user_ids=[user_id]).get(user_id)
+
+    def load_users_profiles(
+        self, user_ids: List[int], strict: bool = False
+    ) -> Dict[int, UserModel]:
+        """
+        按user_id批量查询用户信息, user_ids会按settings.bulk_chunk_size分批查询
+        strict为True时查询失败直接抛出异常
+        """
+        profiles: Dict[int, UserModel] = {}
+        for chunk in chunks(user_ids, settings.bulk_chunk_size):
+            id_list = ", ".join(str(int(user_id)) for user_id in chunk)
+            query = f"""
+            SELECT * FROM EXTERNAL_QUERY(
+              "{self.kuse_ai_table()}",
+              \"""
+                SELECT
+                  u.id,
+                  u.email,
+                  u.given_name,
+                  u.family_name,
+                  u.image_url,
+                  u.output_language,
+                  u.full_name
+                FROM user AS u
+                WHERE id IN ({id_list})
+              \"""
+            )
+            """
+
+            user_id = chunk[0] if len(chunk) == 1 else 0
+            results = self._invoke(
+                user_id=user_id, query=query, tag="load_users_profiles", strict=strict
             )
-            return model
+            for row in results:
+                model = UserModel(user_id=row[0])
+                model.__dict__.update(
+                    {
+                        "email": row[1],
+                        "given_name": row[2],
+                        "family_name": row[3],
+                        "image_url": row[4],
+                        "output_language": row[5],
+                        "full_name": row[6],
+                    }
+                )
+                profiles[model.user_id] = model
 
-        return None
+        return profiles
 
-    def load_user_prompts(self, user_id: int) -> List[str]:
+    def load_user_prompts(self, user_id: int, limit: int = -1) -> List[str]:
         """
-        通过bigquery从kuse_ai项目的mysql数据库tasks表里查询用户用过的prompt
+        通过bigquery从kuse_ai项目的mysql数据库tasks表里查询用户用过的不重复prompt
+        按最近使用时间倒序, limit < 0 时使用settings.max_task_prompts, limit == 0 表示不限制条数
         """
-        query = f"""
-        SELECT * FROM EXTERNAL_QUERY(
-          "{self.kuse_ai_table()}",
-          \"""
-           SELECT
-            u.id,
-            CONVERT(task_meta USING utf8) AS task_meta
-          FROM tasks AS u
-          WHERE u.task_type = 'communication'
-          AND u.user_id = {user_id}
-          \"""
-        )
+        return [p.prompt for p in self.load_user_prompt_records(user_id, limit)]
+
+    def load_user_prompt_records(
+        self, user_id: int, limit: int = -1
+    ) -> List[UserPrompt]:
+        """
+        同load_user_prompts, 带上每条prompt最近一次使用的时间和用户的总task数
+        """
+        if limit < 0:
+            limit = settings.max_task_prompts
+        if self._snapshot is not None and self._snapshot.contains(user_id):
+            return self._snapshot.load_user_prompts(user_id=user_id, limit=limit)
+        return self.load_users_prompts(user_ids=[user_id], limit=limit).get(user_id, [])
+
+    def load_user_prompt_history(
+        self, user_id: int, since: Optional[datetime] = None
+    ) -> List[UserPrompt]:
         """
+        用于历史摘要: 不截断条数, 只查询最近使用时间在since之后的prompt, since为None时查询全部
+        快照里的prompt已经按settings.max_task_prompts截断, 所以总是直接查询
+        """
+        return self.load_users_prompts(user_ids=[user_id], limit=0, since=since).get(
+            user_id, []
+        )
 
-        results = self._invoke(user_id=user_id, query=query, tag="load_user_prompts")
-        prompts: List[str] = list()
-        for row in results:
-            try:
-                d = json.loads(row[1])
+    def load_users_prompts(
+        self,
+        user_ids: List[int],
+        limit: int = -1,
+        strict: bool = False,
+        since: Optional[datetime] = None,
+    ) -> Dict[int, List[UserPrompt]]:
+        """
+        按user_id批量查询用户用过的不重复prompt, 每个用户最多limit条, 按最近使用时间倒序
+        limit < 0 时使用settings.max_task_prompts, limit == 0 表示不限制条数
+        since不为空时只返回最近使用时间在since之后的prompt
+        每条记录带上用户有prompt的task总数(去重和截断之前), 用于判断用户是否有足够的task
+        prompt的提取和去重在mysql里完成, user_ids会按settings.bulk_chunk_size分批查询
+        """
+        if limit < 0:
+            limit = settings.max_task_prompts
+        limit_clause = f"WHERE t.rn <= {int(limit)}" if limit > 0 else ""
+        since_clause = (
+            f"AND MAX(p.created_at) > '{since:%Y-%m-%d %H:%M:%S.%f}'" if since else ""
+        )
+        prompts: Dict[int, List[UserPrompt]] = {user_id: [] for user_id in user_ids}
+        for chunk in chunks(user_ids, settings.bulk_chunk_size):
+            id_list = ", ".join(str(int(user_id)) for user_id in chunk)
+            query = f"""
+            SELECT * FROM EXTERNAL_QUERY(
+              "{self.kuse_ai_table()}",
+              \"""
+              SELECT
+                t.user_id,
+                t.prompt,
+                t.created_at,
+                t.task_count
+              FROM (
+                SELECT
+                  p.user_id,
+                  JSON_UNQUOTE(p.raw_prompt) AS prompt,
+                  MAX(p.created_at) AS created_at,
+                  SUM(COUNT(*)) OVER (PARTITION BY p.user_id) AS task_count,
+                  ROW_NUMBER() OVER (
+                    PARTITION BY p.user_id ORDER BY MAX(p.created_at) DESC
+                  ) AS rn
+                FROM (
+                  SELECT
+                    u.user_id,
+                    JSON_EXTRACT(CONVERT(u.task_meta USING utf8mb4), '$.prompt') AS raw_prompt,
+                    u.created_at
+                  FROM tasks AS u
+                  WHERE u.task_type = 'communication'
+                  AND u.user_id IN ({id_list})
+                  AND JSON_VALID(CONVERT(u.task_meta USING utf8mb4))
+                ) AS p
+                WHERE JSON_TYPE(p.raw_prompt) = 'STRING'
+                GROUP BY p.user_id, prompt
+                HAVING prompt <> '' {since_clause}
+              ) AS t
+              {limit_clause}
+              ORDER BY t.user_id, t.created_at DESC
+              \"""
+            )
+            """
 
-                prompt = d.get("prompt", "")
-                if not prompt:
-                    continue
-                prompts.append(prompt)
-            except Exception as err:
-                logger.error(
-                    f"load_user_prompts.err {err}, row: {row}, user_id: {user_id}"
-                )
-                continue
+            user_id = chunk[0] if len(chunk) == 1 else 0
+            results = self._invoke(
+                user_id=user_id, query=query, tag="load_users_prompts", strict=strict
+            )
+            for row in results:
+                prompt = UserPrompt(user_id=row[0])
+                prompt.prompt = row[1]
+                prompt.created_at = row[2]
+                prompt.task_count = int(row[3] or 0)
+                prompts.setdefault(prompt.user_id, []).append(prompt)
 
         return prompts
 
     def load_user_filenames(self, user_id: int) -> List[str]:
         """
-        通过bigquery从kuse_ai项目的mysql数据库files表里查询用户上传过的文件名
+        通过bigquery从kuse_ai项目的mysql数据库files表里查询用户最近上传过的文件名
         """
-        query = f"""
-        SELECT * FROM EXTERNAL_QUERY(
-          "{self.kuse_ai_table()}",
-          \"""
-          SELECT
-            u.id,
-	    u.filename
-          FROM files AS u
-          WHERE u.id = {user_id}
-          \"""
-        )
+        if self._snapshot is not None and self._snapshot.contains(user_id):
+            files = self._snapshot.load_user_files(
+                user_id=user_id, limit=settings.max_user_files
+            )
+        else:
+            files = self.load_users_files(user_ids=[user_id]).get(user_id, [])
+        return [f.filename for f in files]
+
+    def load_users_files(
+        self, user_ids: List[int], limit: int = -1, strict: bool = False
+    ) -> Dict[int, List[UserFile]]:
+        """
+        按user_id批量查询用户最近上传的不重复文件名, 每个用户最多limit个, 按上传时间倒序
+        user_ids会按settings.bulk_chunk_size分批查询
         """
+        if limit < 0:
+            limit = settings.max_user_files
+        files: Dict[int, List[UserFile]] = {user_id: [] for user_id in user_ids}
+        for chunk in chunks(user_ids, settings.bulk_chunk_size):
+            id_list = ", ".join(str(int(user_id)) for user_id in chunk)
+            query = f"""
+            SELECT * FROM EXTERNAL_QUERY(
+              "{self.kuse_ai_table()}",
+              \"""
+              SELECT
+                f.user_id,
+                f.filename,
+                f.created_at
+              FROM (
+                SELECT
+                  u.user_id,
+                  u.filename,
+                  MAX(u.created_at) AS created_at,
+                  ROW_NUMBER() OVER (
+                    PARTITION BY u.user_id ORDER BY MAX(u.created_at) DESC
+                  ) AS rn
+                FROM files AS u
+                WHERE u.user_id IN ({id_list})
+                AND u.filename IS NOT NULL
+                AND u.filename <> ''
+                GROUP BY u.user_id, u.filename
+              ) AS f
+              WHERE f.rn <= {int(limit)}
+              ORDER BY f.user_id, f.created_at DESC
+              \"""
+            )
+            """
 
-        results = self._invoke(user_id=user_id, query=query, tag="load_user_filenames")
-        file_names: List[str] = list()
-        for row in results:
-            file_name = row[1]
-            if not file_name:
-                continue
-            file_names.append(file_name)
+            user_id = chunk[0] if len(chunk) == 1 else 0
+            results = self._invoke(
+                user_id=user_id, query=query, tag="load_users_files", strict=strict
+            )
+            for row in results:
+                user_file = UserFile(user_id=row[0])
+                user_file.filename = row[1]
+                user_file.created_at = row[2]
+                files.setdefault(user_file.user_id, []).append(user_file)
 
-        return file_names
+        return files
 
     def load_user_from_mixpanel(self, user_id: int) -> Optional[UserProperty]:
         """
         通过bigquery从mixpanel获取用户的其他个人信息
+        已经preload_mixpanel过的用户直接从内存里取
+        """
+        if user_id in self._mixpanel_loaded:
+            return self._mixpanel_users.get(user_id)
+        return self.load_users_from_mixpanel(user_ids=[user_id]).get(user_id)
+
+    def preload_mixpanel(self, user_ids: List[int]):
+        """
+        一次查询把这些用户的mixpanel信息加载到内存, 查询失败时不标记, 之后回退到按用户查询
+        """
+        try:
+            users = self.load_users_from_mixpanel(user_ids=user_ids, strict=True)
+        except Exception as err:
+            logger.error(
+                f"bigquery.preload_mixpanel count: {len(user_ids)}, err: {err}"
+            )
+            return
+        self._mixpanel_users.update(users)
+        self._mixpanel_loaded.update(user_ids)
+
+    def mixpanel_columns(self) -> Tuple[str, str]:
         """
+        mixpanel视图的第一列是属性dict(和单个用户查询时的row[0]一致), 只读取这一列
+        重复的行按第一个时间类型的列取最新的一行, 没有时间列时返回空字符串
+        读取表结构不产生查询费用, 结果缓存在内存里
+        """
+        if self._mixpanel_columns is None:
+            schema = self._client.get_table(self.mixpanel_table()).schema
+            order = next(
+                (f.name for f in schema if f.field_type in ["TIMESTAMP", "DATETIME"]),
+                "",
+            )
+            self._mixpanel_columns = (schema[0].name, order)
+        return self._mixpanel_columns
+
+    def load_users_from_mixpanel(
+        self, user_ids: List[int], strict: bool = False
+    ) -> Dict[int, UserProperty]:
+        """
+        通过bigquery从mixpanel批量获取用户的其他个人信息, 只读取distinct_id和属性列
+        同一个用户有多行时取最新的一行, 再按属性内容排序保证每次运行结果一致
+        """
+        users: Dict[int, UserProperty] = {}
+        if not user_ids:
+            return users
+        try:
+            properties, order = self.mixpanel_columns()
+        except Exception as err:
+            if strict:
+                raise
+            logger.error(f"bigquery.mixpanel_columns err: {err}")
+            return users
+        order_by = f"TO_JSON_STRING(`{properties}`)"
+        if order:
+            order_by = f"`{order}` DESC, {order_by}"
         query = f"""
-        SELECT * FROM `{self.mixpanel_table()}` WHERE distinct_id = "{user_id}" LIMIT 1
+        SELECT `{properties}`, distinct_id
+        FROM `{self.mixpanel_table()}`
+        WHERE distinct_id IN UNNEST(@distinct_ids)
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY distinct_id ORDER BY {order_by}) = 1
         """
 
         results = self._invoke(
-            user_id=user_id, query=query, tag="load_user_from_mixpanel"
+            user_id=user_ids[0] if len(user_ids) == 1 else 0,
+            query=query,
+            tag="load_users_from_mixpanel",
+            params=[
+                bigquery.ArrayQueryParameter(
+                    "distinct_ids", "STRING", [str(user_id) for user_id in user_ids]
+                )
+            ],
+            strict=strict,
         )
-        try:
-            for row in results:
-                user = UserProperty(user_id=user_id)
+        for row in results:
+            try:
+                user = UserProperty(user_id=int(row[1]))
                 user.load_from_mixpanel(row[0])
-                return user
-        except Exception as err:
-            logger.error(f"load_user_from_mixpanel user_id: {user_id}, err:{err}")
-        return None
+                users[user.user_id] = user
+            except Exception as err:
+                logger.error(f"load_users_from_mixpanel row: {row}, err:{err}")
+        return users
 
 
 class Pinecone(object):
@@ -240,6 +602,9 @@ class Pinecone(object):
         通过pinecont获取用户上传过的文件的summary
         """
         summaries: List[str] = list()
+        breaker = breakers["pinecone"]
+        if not breaker.allow():
+            return summaries
         try:
             query = {
                 "user_id": {"$eq": user_id},
@@ -259,7 +624,9 @@ class Pinecone(object):
                 if not summary:
                     continue
                 summaries.append(summary)
+            breaker.record_success()
         except Exception as err:
+            breaker.record_failure()
             logger.error(
                 f"pinecone.search_user_file_summary user_id: {user_id}, err: {err}"
             )
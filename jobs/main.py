@@ -1,11 +1,42 @@
 from env import settings, logger
 from inputs import bq, pc
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Set, Tuple
 from mixpanel import Mixpanel, Consumer
-from schemas import UserPredict
-from prompts import USER_INSIGHT_SYSTEM_PROMPT, format_user_prompt, USER_AVATAR_PROMPT
+from schemas import (
+    UserPredict,
+    UserInputs,
+    UserPrompt,
+    HistorySummary,
+    Variant,
+    predict_properties,
+    changed_fields,
+)
+from metrics import Usage, Budget, SinkStats
+from store import ResultStore
+from sink import WriteBehind
+from breaker import breakers, CircuitOpen
+from hedge import Hedger
+from summary import SummaryStore, newer_prompts, watermark, chunk_prompts
+from prompts import (
+    USER_INSIGHT_SYSTEM_PROMPT,
+    USER_INSIGHT_JSON_SCHEMA,
+    format_user_prompt,
+    format_user_input,
+    format_packed_prompt,
+    is_valid_insight,
+    estimate_tokens,
+    USER_AVATAR_PROMPT,
+    format_avatar_batch_prompt,
+    USER_HISTORY_SUMMARY_PROMPT,
+    format_summary_input,
+)
 from openai import OpenAI
+from avatar import AvatarProcessor, Avatar
+from utils import chunks
+from concurrent.futures import ThreadPoolExecutor
 import json
+import signal
+import threading
 import time
 
 
@@ -16,6 +47,55 @@ class UserInsight(object):
             token=settings.mixpanel_token, consumer=Consumer(retry_limit=2)
         )
         self._llm = OpenAI(api_key=settings.openai_api_key)
+        self._avatars = AvatarProcessor()
+        # 处理后的头像digest -> 描述, 相同头像只调用一次vision
+        self._image_descriptions: Dict[str, str] = {}
+        # 头像url -> 处理后的头像digest, 空字符串表示默认头像或者已失效; 不缓存图片数据
+        self._avatar_digests: Dict[str, str] = {}
+        self._store: Optional[ResultStore] = None
+        if settings.result_store_path:
+            self._store = ResultStore(path=settings.result_store_path)
+        self._store_rows: List[dict] = []
+        self._summaries: Optional[SummaryStore] = None
+        if settings.summary_store_path:
+            self._summaries = SummaryStore(path=settings.summary_store_path)
+        # 为False时只使用已有的历史摘要, 不调用llm生成也不写入, 例如录制评估输入时
+        self.summary_writes: bool = True
+        # user_id -> 上一次同步出去的结果(row_data + version), 用于只同步有变化的字段
+        self._last_predicts: Dict[int, dict] = {}
+        # user_id -> (结果, 还没有写完的同步目标), 全部写成功后才记为上一次的结果并写入结果库
+        self._pending_syncs: Dict[int, Tuple[dict, Set[str]]] = {}
+        self._sync_lock = threading.Lock()
+        self.sink_stats: Dict[str, SinkStats] = {
+            "mixpanel": SinkStats("mixpanel"),
+            "bigquery": SinkStats("bigquery"),
+        }
+        self._sinks: Dict[str, WriteBehind] = {
+            "mixpanel": WriteBehind(
+                stats=self.sink_stats["mixpanel"],
+                write=self._write_mixpanel,
+                workers=settings.sink_workers,
+                queue_size=settings.sink_queue_size,
+                done=lambda item, ok: self._on_synced("mixpanel", item[0], ok),
+            ),
+            "bigquery": WriteBehind(
+                stats=self.sink_stats["bigquery"],
+                write=self._write_bigquery,
+                workers=settings.sink_workers,
+                queue_size=settings.sink_queue_size,
+                done=lambda item, ok: self._on_synced("bigquery", item["user_id"], ok),
+            ),
+        }
+        # 收到SIGTERM/SIGINT后不再开始新的用户, 写完已提交的结果后退出
+        self._stopping = False
+        self.variant = Variant()
+        self.usage = Usage()
+        self.budget = Budget(usage=self.usage)
+        # 运行提前停止时停在了哪个用户, 以及原因
+        self.stopped_at: Optional[dict] = None
+        # 等待合并成一次请求的小用户: user_id -> (输入, 格式化后的输入)
+        self._packed: Dict[int, Tuple[UserInputs, str]] = {}
+        self.hedger = Hedger()
         self.version = settings.version
         logger.info(f"init finished, is_test: {self.is_test}, version: {self.version}")
 
@@ -23,44 +103,319 @@ class UserInsight(object):
         if not user_ids or len(user_ids) == 0:
             user_ids = bq.load_user_ids()
         count = len(user_ids)
+        if settings.snapshot_enabled:
+            start = int(time.time())
+            bq.build_snapshot(user_ids=user_ids)
+            logger.info(
+                f"user_insight.snapshot count: {count}, cost: {int(time.time()) - start}"
+            )
+        bq.preload_mixpanel(user_ids=user_ids)
+        self._preload_last_predicts(user_ids=user_ids)
+        self._handle_signals()
         logger.info(f"start predict job... count: {count}")
-        for index in range(count):
+        try:
+            self._predict_all(user_ids=user_ids)
+        finally:
+            self._close_sinks()
+            self._flush_store()
+            bq.close_snapshot()
+            bq.log_stats()
+            logger.info(f"user_insight.usage {self.usage.to_data()}")
+            logger.info(f"user_insight.hedge {self.hedger.to_data()}")
+            logger.info(f"user_insight.breakers {breakers.to_data()}")
+            for stats in self.sink_stats.values():
+                logger.info(f"user_insight.sink {stats.name} {stats.to_data()}")
+
+    def _predict_all(self, user_ids: List[int]):
+        """
+        预测所有用户, 最后把等待合并的用户发出去; 因为预算或熔断停止时_record_stop已经清空了等待的用户
+        """
+        try:
+            self._predict_users(user_ids=user_ids)
+        finally:
+            self._flush_packed()
+
+    def _predict_users(self, user_ids: List[int]):
+        count = len(user_ids)
+        index = 0
+        retries = 0
+        while index < count:
+            if self._stopping:
+                self._record_stop(user_ids=user_ids, index=index, reason="signal")
+                return
+            if not breakers.wait(stopping=lambda: self._stopping):
+                self._stopping = True
+                self._record_stop(user_ids=user_ids, index=index, reason="breaker")
+                return
+            if not self._check_budget():
+                self._record_stop(user_ids=user_ids, index=index, reason="budget")
+                return
+            if retries == 0 and self._should_prefetch_avatars(index):
+                self._prefetch_avatars(
+                    user_ids=user_ids[index : index + settings.avatar_prefetch]
+                )
             start = int(time.time())
-            user_predict = self.predcit(user_id=user_ids[index])
+            user_id = user_ids[index]
+            failures = breakers.failures()
+            inputs = self.load_inputs(user_id=user_id)
+            user_input = self._pack_input(inputs=inputs)
+            user_predict = None
+            if inputs is not None and not user_input:
+                user_predict = self.predict_inputs(inputs=inputs)
+            if breakers.failures() != failures:
+                # 必需的依赖调用失败过, 结果不完整, 等依赖恢复后重试这个用户
+                if retries < settings.breaker_user_retries:
+                    retries += 1
+                    continue
+                logger.warn(f"user_insight.degraded [{index + 1}/{count}] {user_id}")
+                user_input = ""
+                user_predict = None
+            index += 1
+            retries = 0
+            if user_input and inputs is not None:
+                self._packed[user_id] = (inputs, user_input)
+                if self._packed_full():
+                    self._flush_packed()
+                continue
             if not user_predict:
-                logger.info(
-                    f"user_insight.skip [{index + 1}/{count}] {user_ids[index]}"
+                logger.info(f"user_insight.skip [{index}/{count}] {user_id}")
+                continue
+            self._finish(
+                user_predict=user_predict, position=f"{index}/{count}", start=start
+            )
+
+    def _finish(self, user_predict: UserPredict, position: str, start: int):
+        self.update_predict(user_predict=user_predict)
+        self._flush_store(min_rows=settings.result_store_flush)
+        logger.info(
+            f"user_insight.predict [{position}] {user_predict.row_data()}, cost: {int(time.time()) - start}"
+        )
+
+    def _pack_input(self, inputs: Optional[UserInputs]) -> str:
+        """
+        开启合并预测时, 输入足够小的用户返回格式化后的输入, 否则返回空字符串单独预测
+        """
+        if not settings.pack_enabled or inputs is None:
+            return ""
+        user_input = format_user_input(**self._prompt_kwargs(inputs, self.variant))
+        if estimate_tokens(user_input) > settings.pack_user_tokens:
+            return ""
+        return user_input
+
+    def _packed_full(self) -> bool:
+        if len(self._packed) >= settings.pack_max_users:
+            return True
+        tokens = sum(estimate_tokens(text) for _, text in self._packed.values())
+        return tokens >= settings.pack_max_tokens
+
+    def _flush_packed(self):
+        """
+        把等待中的小用户合成一次请求, 按user_id拆分结果; 结果缺失或无效的用户单独再预测一次
+        输入按发出时的variant重新格式化, 缓冲期间切换了variant(如超过soft预算)时prompt和模型也保持一致
+        """
+        if not self._packed:
+            return
+        packed = self._packed
+        self._packed = {}
+        variant = self.variant
+        start = int(time.time())
+        results: dict = {}
+        if len(packed) > 1:
+            prompt = format_packed_prompt(
+                {
+                    user_id: format_user_input(**self._prompt_kwargs(inputs, variant))
+                    for user_id, (inputs, _) in packed.items()
+                }
+            )
+            reply = self._call_llm(prompt=prompt, variant=variant, packed=True)
+            try:
+                results = json.loads(reply) if reply else {}
+            except Exception as err:
+                logger.error(
+                    f"predict.packed.unmarshal count: {len(packed)}, err: {err}"
                 )
+            if not isinstance(results, dict):
+                results = {}
+
+        fallback = 0
+        for user_id, (inputs, _) in packed.items():
+            result = results.get(str(user_id))
+            if is_valid_insight(result):
+                user_predict: Optional[UserPredict] = UserPredict(user_id=user_id)
+                user_predict.load_from_data(result)
+            else:
+                fallback += 1
+                user_predict = self.predict_inputs(inputs=inputs, variant=variant)
+            if not user_predict:
+                logger.info(f"user_insight.skip [packed] {user_id}")
                 continue
-            self.update_predict(user_predict=user_predict)
-            logger.info(
-                f"user_insight.predict [{index + 1}/{count}] {user_predict.row_data()}, cost: {int(time.time()) - start}"
+            self._finish(user_predict=user_predict, position="packed", start=start)
+        logger.info(f"user_insight.packed count: {len(packed)}, fallback: {fallback}")
+
+    def _check_budget(self) -> bool:
+        """
+        超过soft预算后换成更便宜的配置继续, 超过hard预算时返回False停止运行
+        """
+        level = self.budget.level()
+        if level == Budget.HARD:
+            logger.error(f"user_insight.budget.hard usage: {self.usage.to_data()}")
+            return False
+        if level == Budget.SOFT and self.variant.name != "budget":
+            variant = Variant(name="budget")
+            variant.load_from_data(settings.budget_variant)
+            logger.warn(
+                f"user_insight.budget.soft usage: {self.usage.to_data()}, switch to {variant.__dict__}"
             )
+            self.variant = variant
+        return True
+
+    def _record_stop(self, user_ids: List[int], index: int, reason: str):
+        """
+        记录运行停在了哪里, 下次可以从next_user_id继续
+        因为预算或熔断停止时不再发出等待合并的请求, 这些用户记在pending_user_ids里, 下次需要重新预测
+        """
+        pending: List[int] = []
+        if reason in ["budget", "breaker"]:
+            pending = list(self._packed)
+            self._packed = {}
+        self.stopped_at = {
+            "reason": reason,
+            "version": self.version,
+            "index": index,
+            "count": len(user_ids),
+            "next_user_id": user_ids[index],
+            "pending_user_ids": pending,
+            "usage": self.usage.to_data(),
+            "stopped_at": int(time.time()),
+        }
+        logger.warn(f"user_insight.stopped {self.stopped_at}")
+        if not settings.run_state_path:
+            return
+        with open(settings.run_state_path, "w") as f:
+            json.dump(self.stopped_at, f)
+
+    def _handle_signals(self):
+        """
+        cloud run job结束任务时会先发SIGTERM, 留出时间把队列里的结果写完
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
+
+        def stop(signum, frame):
+            logger.warn(f"user_insight.signal {signum}, stopping...")
+            self._stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+    def _close_sinks(self):
+        timeout = settings.sink_drain_timeout if self._stopping else 0
+        for sink in self._sinks.values():
+            sink.close(timeout=timeout)
 
     def predcit(self, user_id: int) -> Optional[UserPredict]:
+        inputs = self.load_inputs(user_id=user_id)
+        if inputs is None:
+            return None
+        return self.predict_inputs(inputs=inputs)
+
+    def load_inputs(self, user_id: int) -> Optional[UserInputs]:
+        """
+        加载预测一个用户需要的全部输入, 用户不存在或者prompt太少时返回None
+        """
         user_profile = bq.load_user_profile(user_id=user_id)
         if not user_profile:
             logger.warn(f"predict.load_user_profile.not_found user_id: {user_id}")
             return None
 
-        task_prompts = bq.load_user_prompts(user_id=user_id)
-        if len(task_prompts) <= settings.min_task_count:
+        records = bq.load_user_prompt_records(user_id=user_id)
+        # 和之前一样按task总数判断, 而不是去重后的prompt数
+        task_count = records[0].task_count if records else 0
+        if task_count <= settings.min_task_count:
             return None
-        filenames = bq.load_user_filenames(user_id=user_id)
-        summaries = pc.search_user_file_summary(user_id=user_id)
-
-        user_property = bq.load_user_from_mixpanel(user_id=user_id)
-        image_description = self.describe_image(user_profile.image_url)
-
-        prompt = format_user_prompt(
-            user_profile=user_profile,
-            filenames=filenames,
-            task_prompts=task_prompts,
-            summaries=summaries,
-            image_description=image_description,
-            user_property=user_property,
+
+        inputs = UserInputs(user_id=user_id)
+        inputs.user_profile = user_profile
+        inputs.task_prompts = [r.prompt for r in records]
+        self._apply_history_summary(inputs=inputs, records=records)
+        inputs.filenames = bq.load_user_filenames(user_id=user_id)
+        inputs.summaries = pc.search_user_file_summary(user_id=user_id)
+        inputs.user_property = bq.load_user_from_mixpanel(user_id=user_id)
+        if self.variant.use_avatar:
+            inputs.image_description = self.describe_image(user_profile.image_url)
+        return inputs
+
+    def _apply_history_summary(self, inputs: UserInputs, records: List[UserPrompt]):
+        """
+        重度用户只发送历史摘要和水位线之后的新prompt(至少保留最近的settings.summary_recent_prompts条)
+        新prompt攒够settings.summary_refresh_prompts条时增量合并进摘要并推进水位线
+        records已经按settings.max_task_prompts截断, 只用来判断是否需要更新摘要;
+        生成摘要时另外查询水位线之后(第一次时是全部)不截断的历史prompt
+        """
+        if self._summaries is None or len(records) < settings.summary_min_prompts:
+            return
+        summary = self._summaries.get(user_id=inputs.user_id)
+        new = newer_prompts(records=records, summary=summary)
+        if self.summary_writes and (
+            summary is None or len(new) >= settings.summary_refresh_prompts
+        ):
+            history = bq.load_user_prompt_history(
+                user_id=inputs.user_id, since=summary.watermark if summary else None
+            )
+            # history按时间倒序, 摘要按时间正序合并
+            text = self._summarize(
+                previous=summary.summary if summary else "",
+                task_prompts=[r.prompt for r in reversed(history)],
+            )
+            if history and text:
+                prompt_count = summary.prompt_count if summary else 0
+                summary = HistorySummary(user_id=inputs.user_id)
+                summary.summary = text
+                summary.watermark = watermark(history)
+                summary.prompt_count = prompt_count + len(history)
+                self._summaries.put(summary)
+                new = []
+        if summary is None:
+            return
+        keep = max(len(new), settings.summary_recent_prompts)
+        inputs.history_summary = summary.summary
+        inputs.task_prompts = [r.prompt for r in records[:keep]]
+
+    def _summarize(self, previous: str, task_prompts: List[str]) -> str:
+        """
+        把新的prompt按批折叠进已有的摘要, 失败时返回空字符串
+        """
+        summary = previous
+        breaker = breakers["openai"]
+        instructions = USER_HISTORY_SUMMARY_PROMPT.format(
+            max_words=settings.summary_max_words
         )
-        reply = self._call_llm(prompt=prompt)
+        for batch in chunk_prompts(task_prompts, settings.summary_chunk_tokens):
+            try:
+                breaker.check()
+                response = self._llm.responses.create(
+                    model=settings.summary_model,
+                    instructions=instructions,
+                    input=format_summary_input(previous=summary, task_prompts=batch),
+                )
+                breaker.record_success()
+                self._record_usage(settings.summary_model, response.usage)
+                summary = response.output_text.strip()
+            except CircuitOpen:
+                return ""
+            except Exception as err:
+                breaker.record_failure()
+                logger.error(f"summarize err: {err}")
+                return ""
+        return summary
+
+    def predict_inputs(
+        self, inputs: UserInputs, variant: Optional[Variant] = None
+    ) -> Optional[UserPredict]:
+        variant = variant or self.variant
+        user_id = inputs.user_id
+        prompt = format_user_prompt(**self._prompt_kwargs(inputs, variant))
+        reply = self._call_llm(prompt=prompt, variant=variant)
         if not reply:
             return None
         result = {}
@@ -76,57 +431,352 @@ class UserInsight(object):
         user_predict.load_from_data(result)
         return user_predict
 
-    def _call_llm(self, prompt: str) -> str:
+    def _prompt_kwargs(self, inputs: UserInputs, variant: Variant) -> dict:
+        return {
+            "user_profile": inputs.user_profile,
+            "filenames": inputs.filenames,
+            "task_prompts": inputs.task_prompts,
+            "summaries": inputs.summaries,
+            "image_description": inputs.image_description if variant.use_avatar else "",
+            "user_property": inputs.user_property,
+            "prompt_budget": variant.prompt_budget,
+            "history_summary": inputs.history_summary,
+        }
+
+    def _call_llm(
+        self, prompt: str, variant: Optional[Variant] = None, packed: bool = False
+    ) -> str:
+        variant = variant or self.variant
+        breaker = breakers["openai"]
         try:
-            response = self._llm.responses.create(
-                model="gpt-4.1",
-                instructions=USER_INSIGHT_SYSTEM_PROMPT,
-                input=prompt,
+            breaker.check()
+            reply = self.hedger.call(
+                lambda: self._create_response(prompt, variant, packed)
             )
-            return response.output_text
+            breaker.record_success()
+            return reply
+        except CircuitOpen:
+            return ""
         except Exception as err:
+            breaker.record_failure()
             logger.error(f"call_llm err: {err}")
         return ""
 
+    def _create_response(
+        self, prompt: str, variant: Variant, packed: bool = False
+    ) -> str:
+        """
+        发起一次请求并记录用量, 对冲时被丢弃的请求也会记录
+        """
+        response = self._llm.responses.create(
+            model=variant.model,
+            instructions=USER_INSIGHT_SYSTEM_PROMPT,
+            input=prompt,
+            **self._response_format(variant, packed),
+        )
+        self._record_usage(variant.model, response.usage)
+        return response.output_text
+
+    def _response_format(self, variant: Variant, packed: bool = False) -> dict:
+        # 合并请求的key是动态的user_id, 没法用严格的json_schema约束
+        if variant.schema_mode == "json_object" or (
+            packed and variant.schema_mode == "json_schema"
+        ):
+            return {"text": {"format": {"type": "json_object"}}}
+        if variant.schema_mode == "json_schema":
+            return {
+                "text": {
+                    "format": {
+                        "type": "json_schema",
+                        "name": "user_insight",
+                        "schema": USER_INSIGHT_JSON_SCHEMA,
+                        "strict": True,
+                    }
+                }
+            }
+        return {}
+
+    def _record_usage(self, model: str, usage):
+        """
+        记录responses和chat completions两种接口返回的token用量
+        """
+        if usage is None:
+            return
+        input_tokens = getattr(usage, "input_tokens", None)
+        if input_tokens is None:
+            input_tokens = getattr(usage, "prompt_tokens", 0)
+        output_tokens = getattr(usage, "output_tokens", None)
+        if output_tokens is None:
+            output_tokens = getattr(usage, "completion_tokens", 0)
+        self.usage.record(model, input_tokens or 0, output_tokens or 0)
+
     def describe_image(self, image_url: str) -> str:
         """
         given image url, describe the image
+        default or dead avatars are skipped, the rest are downscaled and sent in low detail
         """
-        if not image_url:
+        digest = self._avatar_digests.get(image_url)
+        if digest == "":
+            return ""
+        if digest is not None and digest in self._image_descriptions:
+            return self._image_descriptions[digest]
+
+        avatar = self._process_avatar(image_url)
+        if avatar is None:
             return ""
+        if avatar.digest in self._image_descriptions:
+            return self._image_descriptions[avatar.digest]
+        return self._describe_avatar(avatar)
 
+    def _describe_avatar(self, avatar: Avatar) -> str:
+        breaker = breakers["openai"]
         try:
+            breaker.check()
             response = self._llm.chat.completions.create(
-                model="gpt-4.1",
+                model=settings.vision_model,
                 messages=[
                     {
                         "role": "user",
                         "content": [
-                            {"type": "image_url", "image_url": {"url": image_url}},
+                            {
+                                "type": "image_url",
+                                "image_url": {"url": avatar.data_url, "detail": "low"},
+                            },
                             {"type": "text", "text": USER_AVATAR_PROMPT},
                         ],
                     }
                 ],
             )
-            return response.choices[0].message.content
+            breaker.record_success()
+            self._record_usage(settings.vision_model, response.usage)
+            description = response.choices[0].message.content or ""
+            self._image_descriptions[avatar.digest] = description
+            return description
+        except CircuitOpen:
+            return ""
         except Exception as e:
-            logger.error(f"describe_image url: {image_url} err: {str(e)}")
+            breaker.record_failure()
+            logger.error(f"describe_image url: {avatar.url} err: {str(e)}")
             return ""
 
+    def describe_images(self, image_urls: List[str]):
+        """
+        把没有缓存描述的头像每settings.avatar_batch_size个合成一次vision请求,
+        按label拿回每张图的描述写入缓存, 之后describe_image直接命中缓存
+        """
+        avatars: Dict[str, Avatar] = {}
+        pending_urls = [
+            url
+            for url in set(image_urls)
+            if url not in self._avatar_digests
+            or (
+                self._avatar_digests[url]
+                and self._avatar_digests[url] not in self._image_descriptions
+            )
+        ]
+        with ThreadPoolExecutor(max_workers=settings.avatar_pool_size) as executor:
+            for avatar in executor.map(self._process_avatar, pending_urls):
+                if avatar is None or avatar.digest in self._image_descriptions:
+                    continue
+                avatars[avatar.digest] = avatar
+
+        pending = list(avatars.values())
+        for batch in chunks(pending, settings.avatar_batch_size):
+            if len(batch) == 1:
+                self._describe_avatar(batch[0])
+                continue
+            self._describe_batch(batch)
+
+    def _describe_batch(self, avatars: List[Avatar]):
+        content: List[dict] = []
+        for index, avatar in enumerate(avatars):
+            content.append({"type": "text", "text": f"image_{index + 1}:"})
+            content.append(
+                {
+                    "type": "image_url",
+                    "image_url": {"url": avatar.data_url, "detail": "low"},
+                }
+            )
+        content.append(
+            {"type": "text", "text": format_avatar_batch_prompt(count=len(avatars))}
+        )
+
+        breaker = breakers["openai"]
+        if not breaker.allow():
+            return
+        try:
+            response = self._llm.chat.completions.create(
+                model=settings.vision_model,
+                messages=[{"role": "user", "content": content}],
+                response_format={"type": "json_object"},
+            )
+            breaker.record_success()
+            self._record_usage(settings.vision_model, response.usage)
+            result = json.loads(response.choices[0].message.content or "{}")
+        except Exception as err:
+            if not isinstance(err, json.JSONDecodeError):
+                breaker.record_failure()
+            logger.error(f"describe_images count: {len(avatars)}, err: {err}")
+            return
+
+        for index, avatar in enumerate(avatars):
+            description = result.get(f"image_{index + 1}", "")
+            # 批量结果里缺失的头像留给describe_image单独调用
+            if not isinstance(description, str) or not description:
+                continue
+            self._image_descriptions[avatar.digest] = description
+
+    def _process_avatar(self, image_url: str) -> Optional[Avatar]:
+        """
+        拉取并处理头像, 只记住digest, 处理后的图片数据用完即丢
+        """
+        avatar = self._avatars.process(image_url)
+        self._avatar_digests[image_url] = avatar.digest if avatar else ""
+        return avatar
+
+    def _should_prefetch_avatars(self, index: int) -> bool:
+        if not self.variant.use_avatar or settings.avatar_batch_size <= 1:
+            return False
+        return index % settings.avatar_prefetch == 0
+
+    def _prefetch_avatars(self, user_ids: List[int]):
+        """
+        只为快照里已经有数据并且满足预测条件的用户预先描述头像,
+        不在快照里的用户在预测时再单独描述, 避免重复查询用户信息
+        """
+        image_urls: List[str] = []
+        for user_id in user_ids:
+            if not bq.in_snapshot(user_id=user_id):
+                continue
+            records = bq.load_user_prompt_records(user_id=user_id, limit=1)
+            task_count = records[0].task_count if records else 0
+            if task_count <= settings.min_task_count:
+                continue
+            user_profile = bq.load_user_profile(user_id=user_id)
+            if user_profile and user_profile.image_url:
+                image_urls.append(user_profile.image_url)
+        self.describe_images(image_urls)
+
     def update_predict(self, user_predict: UserPredict):
         """
-        同步最新的分析结果到外部
+        同步最新的分析结果到外部, 所有目标都写成功后才记为上一次的结果并写入结果库
+        测试运行不同步, 也不记录
         """
         if self.is_test:
             return
-        self._update_to_mixpanel(user_predict=user_predict)
-        self._update_to_bigquery(user_predict=user_predict)
+        with self._sync_lock:
+            last = self._last_predicts.get(user_predict.user_id)
+        writes = {
+            "mixpanel": self._update_to_mixpanel(user_predict=user_predict, last=last),
+            "bigquery": self._update_to_bigquery(user_predict=user_predict, last=last),
+        }
+        writes = {name: item for name, item in writes.items() if item is not None}
+        row_data = user_predict.row_data()
+        with self._sync_lock:
+            if not writes:
+                self._record_synced(row_data)
+                return
+            self._pending_syncs[user_predict.user_id] = (row_data, set(writes))
+        for name, item in writes.items():
+            self._sinks[name].put(item)
 
-    def _update_to_bigquery(self, user_predict: UserPredict):
-        bq.upsert_user_predict(version=self.version, row_data=user_predict.row_data())
+    def _on_synced(self, name: str, user_id: int, ok: bool):
+        """
+        一个目标写入完成, 在sink的worker线程里调用; 任意一个目标失败时这次结果不记录
+        """
+        with self._sync_lock:
+            pending = self._pending_syncs.get(user_id)
+            if pending is None:
+                return
+            row_data, sinks = pending
+            sinks.discard(name)
+            if ok and sinks:
+                return
+            del self._pending_syncs[user_id]
+            if ok:
+                self._record_synced(row_data)
+
+    def _record_synced(self, row_data: dict):
+        """
+        调用时需要持有self._sync_lock
+        """
+        self._last_predicts[row_data["user_id"]] = dict(row_data, version=self.version)
+        if self._store is not None:
+            self._store_rows.append(row_data)
+
+    def _preload_last_predicts(self, user_ids: List[int]):
+        """
+        加载这些用户上一次的结果, 优先用本地结果库, 没有配置时从bigquery的user_predict表读取
+        """
+        if not settings.sink_changes_only or self.is_test:
+            return
+        for chunk in chunks(user_ids, settings.bulk_chunk_size):
+            if self._store is not None:
+                self._last_predicts.update(self._store.get_latest(user_ids=chunk))
+            else:
+                self._last_predicts.update(bq.load_users_predict(user_ids=chunk))
+        logger.info(
+            f"user_insight.last_predicts count: {len(self._last_predicts)}/{len(user_ids)}"
+        )
+
+    def _flush_store(self, min_rows: int = 1):
+        """
+        把已经同步成功的结果按version写入本地结果库, 只在主线程调用
+        """
+        if self._store is None:
+            return
+        with self._sync_lock:
+            if len(self._store_rows) < min_rows:
+                return
+            rows = self._store_rows
+            self._store_rows = []
+        self._store.append(version=self.version, rows=rows)
+
+    def _update_to_bigquery(
+        self, user_predict: UserPredict, last: Optional[dict]
+    ) -> Optional[dict]:
+        """
+        返回需要MERGE的结果, 和上一次的结果(不管是哪个version)相比没有变化时返回None
+        """
+        stats = self.sink_stats["bigquery"]
+        row_data = user_predict.row_data()
+        if last is not None:
+            changed = changed_fields(
+                last, {k: v for k, v in row_data.items() if k != "user_id"}
+            )
+            if not changed:
+                stats.record_skip(fields=len(row_data) - 1)
+                return None
+        stats.record_write(fields=len(row_data) - 1)
+        return row_data
+
+    def _write_bigquery(self, row_data: dict):
+        bq.upsert_user_predict(version=self.version, row_data=row_data, strict=True)
+
+    def _update_to_mixpanel(
+        self, user_predict: UserPredict, last: Optional[dict]
+    ) -> Optional[tuple]:
+        """
+        返回需要同步到mixpanel的(user_id, 属性), 只包含和上一次结果相比有变化的predict_*属性, 没有变化时返回None
+        """
+        stats = self.sink_stats["mixpanel"]
+        properties = user_predict.properties()
+        if last is not None:
+            changed = changed_fields(predict_properties(last), properties)
+            if not changed:
+                stats.record_skip(fields=len(properties))
+                return None
+            stats.record_write(
+                fields=len(changed), skipped_fields=len(properties) - len(changed)
+            )
+            properties = changed
+        else:
+            stats.record_write(fields=len(properties))
+        return (user_predict.user_id, properties)
 
-    def _update_to_mixpanel(self, user_predict: UserPredict):
-        self._mixpanel.people_set(user_predict.user_id, user_predict.properties())
+    def _write_mixpanel(self, item: tuple):
+        user_id, properties = item
+        self._mixpanel.people_set(user_id, properties)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,129 @@
+from typing import Dict, List
+from env import settings
+import threading
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int) -> float:
+    """
+    按settings.model_prices估算一次调用的花费(美元), 未知模型按0计算
+    """
+    input_price, output_price = settings.model_prices.get(model, (0.0, 0.0))
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+class Usage(object):
+    """
+    累计LLM调用次数, 输入输出token和估算花费, 可以在多个线程里记录
+    """
+
+    def __init__(self):
+        self.calls: int = 0
+        self.input_tokens: int = 0
+        self.output_tokens: int = 0
+        self.cost: float = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, model: str, input_tokens: int, output_tokens: int):
+        with self._lock:
+            self.calls += 1
+            self.input_tokens += input_tokens
+            self.output_tokens += output_tokens
+            self.cost += estimate_cost(model, input_tokens, output_tokens)
+
+    def to_data(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "input_tokens": self.input_tokens,
+                "output_tokens": self.output_tokens,
+                "cost": round(self.cost, 6),
+            }
+
+
+class Budget(object):
+    """
+    按Usage累计的token和花费判断是否超过单次运行的soft/hard预算
+    """
+
+    SOFT = "soft"
+    HARD = "hard"
+
+    def __init__(self, usage: Usage):
+        self._usage = usage
+
+    def level(self) -> str:
+        """
+        返回当前超过的预算等级, 都没有超过时返回空字符串
+        """
+        data = self._usage.to_data()
+        tokens = data["input_tokens"] + data["output_tokens"]
+        if _exceeded(data["cost"], settings.budget_hard_cost) or _exceeded(
+            tokens, settings.budget_hard_tokens
+        ):
+            return self.HARD
+        if _exceeded(data["cost"], settings.budget_soft_cost) or _exceeded(
+            tokens, settings.budget_soft_tokens
+        ):
+            return self.SOFT
+        return ""
+
+
+def _exceeded(value: float, limit: float) -> bool:
+    return limit > 0 and value >= limit
+
+
+class SinkStats(object):
+    """
+    记录一个同步目标(mixpanel, bigquery)的写入和因为没有变化而跳过的次数
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.writes: int = 0
+        self.written_fields: int = 0
+        self.skipped_users: int = 0
+        self.skipped_fields: int = 0
+        self.errors: int = 0
+        # 队列满时提交写入被阻塞的次数和总时长(秒)
+        self.blocked: int = 0
+        self.blocked_seconds: float = 0.0
+        self._lock = threading.Lock()
+
+    def record_write(self, fields: int, skipped_fields: int = 0):
+        with self._lock:
+            self.writes += 1
+            self.written_fields += fields
+            self.skipped_fields += skipped_fields
+
+    def record_skip(self, fields: int):
+        with self._lock:
+            self.skipped_users += 1
+            self.skipped_fields += fields
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def record_blocked(self, seconds: float):
+        with self._lock:
+            self.blocked += 1
+            self.blocked_seconds += seconds
+
+    def to_data(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "writes": self.writes,
+                "written_fields": self.written_fields,
+                "skipped_users": self.skipped_users,
+                "skipped_fields": self.skipped_fields,
+                "errors": self.errors,
+                "blocked": self.blocked,
+                "blocked_seconds": round(self.blocked_seconds, 3),
+            }
@@ -1,11 +1,18 @@
 from schemas import UserModel, UserProperty
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+from env import settings
+from dedup import collapse_prompts
 
 
 USER_AVATAR_PROMPT = """
 The picture given to you is an avatar, describe the content of this picture
 """
 
+USER_AVATAR_BATCH_PROMPT = """
+Each picture given to you is the avatar of a different user, labelled image_1 to image_{count} by the text before it.
+Describe the content of each picture independently, and return a single valid JSON object whose keys are the labels and whose values are the descriptions, e.g. {{"image_1": "...", "image_2": "..."}}
+"""
+
 USER_INSIGHT_SYSTEM_PROMPT = """
 You are an AI assistant specialized in user profiling. Based on the following user profile and task records, analyze and infer the user's attributes and return the result in a structured JSON format.
 
@@ -49,6 +56,79 @@ Please analyze the user data below and return a single valid JSON object followi
 """
 
 
+def _candidates_schema() -> dict:
+    return {
+        "type": "object",
+        "properties": {
+            "candidates": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "value": {"type": ["string", "null"]},
+                        "confidence": {"type": "number"},
+                        "evidence": {"type": "string"},
+                    },
+                    "required": ["value", "confidence", "evidence"],
+                    "additionalProperties": False,
+                },
+            }
+        },
+        "required": ["candidates"],
+        "additionalProperties": False,
+    }
+
+
+USER_INSIGHT_ATTRIBUTES = [
+    "primary_language",
+    "gender",
+    "school",
+    "major",
+    "degree_level",
+    "industry",
+    "occupation",
+]
+
+# schema_mode为json_schema时使用的结构化输出格式
+USER_INSIGHT_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {k: _candidates_schema() for k in USER_INSIGHT_ATTRIBUTES},
+    "required": USER_INSIGHT_ATTRIBUTES,
+    "additionalProperties": False,
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算token数, 中文按每个字1个token, 其余按每4个字符1个token
+    """
+    non_ascii = sum(1 for c in text if ord(c) > 127)
+    return non_ascii + (len(text) - non_ascii) // 4 + 1
+
+
+USER_INSIGHT_PACK_PROMPT = """
+The input contains {count} different users, each one starts with a "## User <user_id>" line.
+Analyze each user independently, never mix the information of different users.
+Return a single valid JSON object whose keys are the user ids as strings, and whose values are the persona JSON of that user following the format above, e.g. {{"123": {{"primary_language": {{"candidates": [...]}}, ...}}, "456": {{...}}}}
+"""
+
+
+USER_HISTORY_SUMMARY_PROMPT = """
+You maintain a condensed summary of one user's task history, which is later used to infer the user's primary_language, gender, school, major, degree_level, industry and occupation.
+You are given the existing summary (it may be empty) and the user's newer task prompts.
+Return an updated summary in plain text of at most {max_words} words that:
+- keeps every piece of evidence useful for the attributes above (subjects, courses, schools, job duties, tools, domains, document types)
+- records which languages the user writes in, and roughly how often
+- quotes a few short representative original phrases
+- drops one-off noise and repeated templates
+Return only the summary text.
+"""
+
+
+def format_avatar_batch_prompt(count: int) -> str:
+    return USER_AVATAR_BATCH_PROMPT.format(count=count)
+
+
 def format_user_prompt(
     user_profile: UserModel,
     filenames: List[str],
@@ -56,10 +136,48 @@ def format_user_prompt(
     summaries: List[str],
     image_description: str,
     user_property: Optional[UserProperty],
+    prompt_budget: int = 0,
+    history_summary: str = "",
 ) -> str:
+    """
+    task_prompts按最近使用时间倒序, prompt_budget > 0 时只保留预算内最近的prompt
+    """
     prompt = "## Input:\n"
+    prompt += format_user_input(
+        user_profile=user_profile,
+        filenames=filenames,
+        task_prompts=task_prompts,
+        summaries=summaries,
+        image_description=image_description,
+        user_property=user_property,
+        prompt_budget=prompt_budget,
+        history_summary=history_summary,
+    )
+
+    # format
+    prompt += """
+Please reason carefully and return only the final JSON result, with no explanation or formatting outside the JSON.
+Now, output the persona JSON:
+        """
+    return prompt
+
+
+def format_user_input(
+    user_profile: UserModel,
+    filenames: List[str],
+    task_prompts: List[str],
+    summaries: List[str],
+    image_description: str,
+    user_property: Optional[UserProperty],
+    prompt_budget: int = 0,
+    history_summary: str = "",
+) -> str:
+    """
+    一个用户的输入数据部分, 单独预测和多用户合并预测共用
+    history_summary不为空时, task_prompts只是摘要之后的新prompt
+    """
     # user_profile
-    prompt += ">User Base Profile:\n"
+    prompt = ">User Base Profile:\n"
     prompt += f"- Email: {user_profile.email}\n"
     prompt += f"- GivenName: {user_profile.given_name}\n"
     prompt += f"- FamilyName: {user_profile.family_name}\n"
@@ -72,15 +190,24 @@ def format_user_prompt(
     if image_description:
         prompt += f"- Profile Image Description: {image_description}\n"
 
+    # history summary
+    if history_summary:
+        prompt += ">Summary of the user's earlier task history:\n"
+        prompt += f"{history_summary.strip()}\n"
+
     # tasks
     if len(task_prompts) > 0:
         prompt += ">The prompt that the user had input, detect the primary_language by following prompts:\n"
-        visited: Dict[str, bool] = {}
-        for task_prompt in task_prompts:
-            if visited.get(task_prompt, False):  # filter repeat prompt
-                continue
-            prompt += f"- {task_prompt}\n"
-            visited[task_prompt] = True
+        used = 0
+        for index, (task_prompt, count) in enumerate(_unique_prompts(task_prompts)):
+            line = f"- {task_prompt}\n"
+            if count > 1:
+                line = f"- {task_prompt} (x{count} similar)\n"
+            if prompt_budget > 0:
+                used += estimate_tokens(line)
+                if used > prompt_budget and index > 0:
+                    break
+            prompt += line
 
     # filenames
     if len(filenames) > 0:
@@ -94,9 +221,62 @@ def format_user_prompt(
         for summary in summaries:
             prompt += f"- {summary}\n"
 
-    # format
+    return prompt
+
+
+def _unique_prompts(task_prompts: List[str]) -> List[Tuple[str, int]]:
+    """
+    开启near_dup时合并近似重复的prompt并带上数量, 否则只过滤完全相同的prompt
+    """
+    if settings.near_dup_enabled:
+        return collapse_prompts(task_prompts)
+    visited: Dict[str, bool] = {}
+    unique: List[Tuple[str, int]] = []
+    for task_prompt in task_prompts:
+        if visited.get(task_prompt, False):  # filter repeat prompt
+            continue
+        visited[task_prompt] = True
+        unique.append((task_prompt, 1))
+    return unique
+
+
+def format_summary_input(previous: str, task_prompts: List[str]) -> str:
+    """
+    task_prompts按时间正序
+    """
+    prompt = ">Existing summary:\n"
+    prompt += f"{previous.strip() or '(empty)'}\n"
+    prompt += ">Newer task prompts:\n"
+    for task_prompt in task_prompts:
+        prompt += f"- {task_prompt}\n"
+    return prompt
+
+
+def format_packed_prompt(user_inputs: Dict[int, str]) -> str:
+    """
+    把多个用户的输入合成一次请求, 要求按user_id返回每个用户的结果
+    """
+    prompt = USER_INSIGHT_PACK_PROMPT.format(count=len(user_inputs))
+    prompt += "\n## Input:\n"
+    for user_id, user_input in user_inputs.items():
+        prompt += f"\n## User {user_id}\n"
+        prompt += user_input
+
     prompt += """
 Please reason carefully and return only the final JSON result, with no explanation or formatting outside the JSON.
-Now, output the persona JSON:
+Now, output the JSON keyed by user id:
         """
     return prompt
+
+
+def is_valid_insight(result: dict) -> bool:
+    """
+    结果里至少有一个属性带candidates列表时认为是有效的单个用户结果
+    """
+    if not isinstance(result, dict):
+        return False
+    for attribute in USER_INSIGHT_ATTRIBUTES:
+        value = result.get(attribute)
+        if isinstance(value, dict) and isinstance(value.get("candidates"), list):
+            return True
+    return False
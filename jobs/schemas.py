@@ -1,4 +1,5 @@
 from typing import Dict, List, Optional
+from datetime import datetime
 from env import settings
 
 
@@ -103,19 +104,33 @@ class UserPredict(object):
         """
         获取需要上传到mixpanel上的数据
         """
-        properties = dict()
-        for key, value in self.row_data().items():
-            if key == "user_id":
-                continue
-            value = value.lower()
-            if value == "zh-cn":
-                value = "simplified chinese"
-            elif value == "zh-tw":
-                value = "traditional chinese"
+        return predict_properties(self.row_data())
+
+
+def predict_properties(row_data: dict) -> dict:
+    """
+    把row_data形式的分析结果转换成mixpanel上的predict_*属性
+    """
+    properties = dict()
+    for key, value in row_data.items():
+        if key in ["user_id", "version"]:
+            continue
+        value = str(value or "").lower()
+        if value == "zh-cn":
+            value = "simplified chinese"
+        elif value == "zh-tw":
+            value = "traditional chinese"
+
+        properties[f"predict_{key}"] = value
+
+    return properties
 
-            properties[f"predict_{key}"] = value
 
-        return properties
+def changed_fields(old: dict, new: dict) -> dict:
+    """
+    返回new里和old不一样的字段
+    """
+    return {k: v for k, v in new.items() if old.get(k) != v}
 
 
 class UserModel(object):
@@ -129,6 +144,96 @@ class UserModel(object):
         self.full_name: str = ""
 
 
+class UserFile(object):
+    def __init__(self, user_id: int):
+        self.user_id: int = user_id
+        self.filename: str = ""
+        self.created_at: Optional[datetime] = None
+
+
+class UserInputs(object):
+    """
+    一个用户用于预测的全部输入, 可以序列化下来离线复现预测
+    """
+
+    def __init__(self, user_id: int):
+        self.user_id: int = user_id
+        self.user_profile: Optional[UserModel] = None
+        self.task_prompts: List[str] = []
+        self.filenames: List[str] = []
+        self.summaries: List[str] = []
+        self.user_property: Optional[UserProperty] = None
+        self.image_description: str = ""
+        # 重度用户: 水位线之前的历史prompt的摘要, task_prompts只包含之后的新prompt
+        self.history_summary: str = ""
+
+    def to_data(self) -> dict:
+        return {
+            "user_id": self.user_id,
+            "user_profile": self.user_profile.__dict__ if self.user_profile else None,
+            "task_prompts": self.task_prompts,
+            "filenames": self.filenames,
+            "summaries": self.summaries,
+            "user_property": (
+                self.user_property.__dict__ if self.user_property else None
+            ),
+            "image_description": self.image_description,
+            "history_summary": self.history_summary,
+        }
+
+    def load_from_data(self, d: dict):
+        if d.get("user_profile"):
+            self.user_profile = UserModel(user_id=self.user_id)
+            self.user_profile.__dict__.update(d["user_profile"])
+        if d.get("user_property"):
+            self.user_property = UserProperty(user_id=self.user_id)
+            self.user_property.__dict__.update(d["user_property"])
+        self.task_prompts = d.get("task_prompts", [])
+        self.filenames = d.get("filenames", [])
+        self.summaries = d.get("summaries", [])
+        self.image_description = d.get("image_description", "")
+        self.history_summary = d.get("history_summary", "")
+
+
+class HistorySummary(object):
+    """
+    用户历史prompt的滚动摘要, watermark是生成摘要时包含的最新prompt的时间
+    """
+
+    def __init__(self, user_id: int):
+        self.user_id: int = user_id
+        self.summary: str = ""
+        self.watermark: Optional[datetime] = None
+        self.prompt_count: int = 0
+        self.updated_at: Optional[datetime] = None
+
+
+class Variant(object):
+    """
+    预测流程的可配置项: 模型, prompt的token预算, 是否使用头像描述, 输出格式约束
+    schema_mode: none(只靠prompt约束), json_object, json_schema
+    """
+
+    def __init__(self, name: str = "default"):
+        self.name: str = name
+        self.model: str = settings.llm_model
+        self.prompt_budget: int = settings.prompt_budget
+        self.use_avatar: bool = True
+        self.schema_mode: str = settings.schema_mode
+
+    def load_from_data(self, d: dict):
+        self.__dict__.update(d)
+
+
+class UserPrompt(object):
+    def __init__(self, user_id: int):
+        self.user_id: int = user_id
+        self.prompt: str = ""
+        self.created_at: Optional[datetime] = None
+        # 用户有prompt的task总数(去重之前), 同一个用户的每条记录都一样
+        self.task_count: int = 0
+
+
 if __name__ == "__main__":
     # ret = UserPredict(user_id=123)
     # ret.load_from_dict(
@@ -0,0 +1,104 @@
+from typing import Any, Callable, List, Optional
+from env import logger
+from metrics import SinkStats
+import queue
+import threading
+import time
+
+# 通知worker退出的标记
+_STOP = object()
+
+
+class WriteBehind(object):
+    """
+    一个同步目标(mixpanel, bigquery)的异步写入:
+    - 有界队列, 队列满时put会阻塞, 给预测主流程施加背压
+    - 固定数量的worker线程调用write, 失败记入stats.errors, 不影响其他写入
+    - 每次写入完成后调用done(item, 是否成功), 在worker线程里执行
+    - close时先把队列里剩下的写完再退出
+    """
+
+    def __init__(
+        self,
+        stats: SinkStats,
+        write: Callable[[Any], None],
+        workers: int,
+        queue_size: int,
+        done: Optional[Callable[[Any, bool], None]] = None,
+    ):
+        self.stats = stats
+        self._write = write
+        self._done = done
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._workers: List[threading.Thread] = []
+        self._closed = False
+        for i in range(workers):
+            worker = threading.Thread(
+                target=self._run, name=f"sink-{stats.name}-{i}", daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def put(self, item: Any):
+        """
+        提交一次写入, 没有worker时直接同步写
+        """
+        if not self._workers:
+            self._do_write(item)
+            return
+        try:
+            self._queue.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+        start = time.time()
+        self._queue.put(item)
+        self.stats.record_blocked(time.time() - start)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                self._do_write(item)
+            finally:
+                self._queue.task_done()
+
+    def _do_write(self, item: Any):
+        ok = True
+        try:
+            self._write(item)
+        except Exception as err:
+            ok = False
+            self.stats.record_error()
+            logger.error(f"sink.{self.stats.name}.write err: {err}")
+        if self._done is not None:
+            self._done(item, ok)
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def close(self, timeout: float = 0):
+        """
+        等队列里的写入全部完成后停止worker, timeout > 0 时最多等待timeout秒
+        """
+        if self._closed:
+            return
+        self._closed = True
+        deadline = time.time() + timeout if timeout > 0 else None
+        for _ in self._workers:
+            # 队列满且worker卡住时, 放入退出标记也不能超过deadline
+            try:
+                self._queue.put(
+                    _STOP,
+                    timeout=(
+                        None if deadline is None else max(0.0, deadline - time.time())
+                    ),
+                )
+            except queue.Full:
+                break
+        for worker in self._workers:
+            worker.join(None if deadline is None else max(0.0, deadline - time.time()))
+        if self.pending() > 0:
+            logger.warn(f"sink.{self.stats.name}.close pending: {self.pending()}")
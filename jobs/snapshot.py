@@ -0,0 +1,190 @@
+from typing import Dict, List, Optional, Set
+from env import settings, logger
+from schemas import UserModel, UserFile, UserPrompt
+import duckdb
+import os
+import pyarrow as pa
+
+
+class Snapshot(object):
+    """
+    本次运行涉及到的用户在user/tasks/files表里的数据的本地duckdb快照
+    每次运行开始时批量导出一次, 之后按user_id在本地查询, 不再逐个用户访问线上mysql
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self._conn = duckdb.connect(path)
+        self._user_ids: Set[int] = set()
+        self._conn.execute(
+            """
+            CREATE TABLE users (
+              user_id BIGINT,
+              email VARCHAR,
+              given_name VARCHAR,
+              family_name VARCHAR,
+              image_url VARCHAR,
+              output_language VARCHAR,
+              full_name VARCHAR
+            )
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE prompts (
+              user_id BIGINT,
+              prompt VARCHAR,
+              created_at TIMESTAMP,
+              task_count BIGINT
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE TABLE files (user_id BIGINT, filename VARCHAR, created_at TIMESTAMP)"
+        )
+
+    def contains(self, user_id: int) -> bool:
+        return user_id in self._user_ids
+
+    def add_profiles(self, profiles: Dict[int, UserModel]):
+        rows = [
+            (
+                p.user_id,
+                p.email,
+                p.given_name,
+                p.family_name,
+                p.image_url,
+                p.output_language,
+                p.full_name,
+            )
+            for p in profiles.values()
+        ]
+        self._insert(
+            "users",
+            [
+                "user_id",
+                "email",
+                "given_name",
+                "family_name",
+                "image_url",
+                "output_language",
+                "full_name",
+            ],
+            rows,
+        )
+
+    def add_prompts(self, prompts: Dict[int, List[UserPrompt]]):
+        rows = [
+            (p.user_id, p.prompt, p.created_at, p.task_count)
+            for user_prompts in prompts.values()
+            for p in user_prompts
+        ]
+        self._insert("prompts", ["user_id", "prompt", "created_at", "task_count"], rows)
+
+    def add_files(self, files: Dict[int, List[UserFile]]):
+        rows = [
+            (f.user_id, f.filename, f.created_at)
+            for user_files in files.values()
+            for f in user_files
+        ]
+        self._insert("files", ["user_id", "filename", "created_at"], rows)
+
+    def mark_loaded(self, user_ids: List[int]):
+        """
+        标记这些用户的数据已经导出完整, 之后对它们的查询都走快照
+        """
+        self._user_ids.update(user_ids)
+
+    def build_index(self):
+        for table in ["users", "prompts", "files"]:
+            self._conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_{table}_user_id ON {table} (user_id)"
+            )
+        logger.info(
+            f"snapshot.build_index path: {self.path}, users: {len(self._user_ids)}"
+        )
+
+    def _insert(self, table: str, columns: List[str], rows: List[tuple]):
+        if not rows:
+            return
+        data = pa.table({c: [row[i] for row in rows] for i, c in enumerate(columns)})
+        cursor = self._conn.cursor()
+        cursor.register("staging", data)
+        cursor.execute(f"INSERT INTO {table} SELECT {', '.join(columns)} FROM staging")
+        cursor.unregister("staging")
+        cursor.close()
+
+    def _query(self, query: str, params: list) -> List[tuple]:
+        cursor = self._conn.cursor()
+        try:
+            return cursor.execute(query, params).fetchall()
+        finally:
+            cursor.close()
+
+    def load_user_profile(self, user_id: int) -> Optional[UserModel]:
+        rows = self._query(
+            """
+            SELECT user_id, email, given_name, family_name, image_url, output_language, full_name
+            FROM users WHERE user_id = ? LIMIT 1
+            """,
+            [user_id],
+        )
+        for row in rows:
+            model = UserModel(user_id=row[0])
+            model.__dict__.update(
+                {
+                    "email": row[1],
+                    "given_name": row[2],
+                    "family_name": row[3],
+                    "image_url": row[4],
+                    "output_language": row[5],
+                    "full_name": row[6],
+                }
+            )
+            return model
+        return None
+
+    def load_user_prompts(self, user_id: int, limit: int) -> List[UserPrompt]:
+        limit_clause = f"LIMIT {int(limit)}" if limit > 0 else ""
+        rows = self._query(
+            f"""
+            SELECT prompt, created_at, task_count FROM prompts
+            WHERE user_id = ?
+            ORDER BY created_at DESC
+            {limit_clause}
+            """,
+            [user_id],
+        )
+        prompts: List[UserPrompt] = list()
+        for row in rows:
+            prompt = UserPrompt(user_id=user_id)
+            prompt.prompt = row[0]
+            prompt.created_at = row[1]
+            prompt.task_count = row[2] or 0
+            prompts.append(prompt)
+        return prompts
+
+    def load_user_files(self, user_id: int, limit: int) -> List[UserFile]:
+        rows = self._query(
+            """
+            SELECT filename, created_at FROM files
+            WHERE user_id = ?
+            ORDER BY created_at DESC
+            LIMIT ?
+            """,
+            [user_id, limit],
+        )
+        files: List[UserFile] = list()
+        for row in rows:
+            user_file = UserFile(user_id=user_id)
+            user_file.filename = row[0]
+            user_file.created_at = row[1]
+            files.append(user_file)
+        return files
+
+    def close(self):
+        self._conn.close()
+        if not settings.snapshot_keep and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,204 @@
+from typing import Dict, Iterator, List, Optional
+import json
+import os
+import sqlite3
+import threading
+import time
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pyarrow.csv as pcsv
+
+
+class ResultStore(object):
+    """
+    本地追加写的预测结果库:
+    - 每次写入的UserPredict.row_data()按version分区保存成parquet, 只追加不修改
+    - sqlite里维护 user_id -> 最新一行 的索引, 用于快速点查和导出最新结果
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._index = sqlite3.connect(
+            os.path.join(path, "index.db"), check_same_thread=False
+        )
+        self._index.execute(
+            """
+            CREATE TABLE IF NOT EXISTS latest (
+              user_id INTEGER PRIMARY KEY,
+              version INTEGER NOT NULL,
+              row TEXT NOT NULL
+            )
+            """
+        )
+        self._index.commit()
+
+    def _partition(self, version: int) -> str:
+        return os.path.join(self.path, f"version={version}")
+
+    def append(self, version: int, rows: List[dict]):
+        """
+        追加一批结果到version分区, 并更新最新结果索引(只会被相同或更新的version覆盖)
+        """
+        if not rows:
+            return
+        with self._lock:
+            partition = self._partition(version)
+            os.makedirs(partition, exist_ok=True)
+            filename = f"part-{time.time_ns()}.parquet"
+            pq.write_table(
+                pa.Table.from_pylist(rows), os.path.join(partition, filename)
+            )
+            self._index.executemany(
+                """
+                INSERT INTO latest (user_id, version, row) VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET version = excluded.version, row = excluded.row
+                WHERE excluded.version >= latest.version
+                """,
+                [
+                    (int(row["user_id"]), version, json.dumps(row, ensure_ascii=False))
+                    for row in rows
+                ],
+            )
+            self._index.commit()
+
+    def versions(self) -> List[int]:
+        versions: List[int] = []
+        for name in os.listdir(self.path):
+            if name.startswith("version="):
+                versions.append(int(name.split("=", 1)[1]))
+        return sorted(versions)
+
+    def get(self, user_id: int) -> Optional[dict]:
+        """
+        点查一个用户最新的一行结果
+        """
+        with self._lock:
+            cursor = self._index.execute(
+                "SELECT row FROM latest WHERE user_id = ?", (user_id,)
+            )
+            row = cursor.fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_latest(self, user_ids: List[int]) -> Dict[int, dict]:
+        """
+        批量查询用户最新的一行结果, 带上写入时的version
+        """
+        rows: Dict[int, dict] = {}
+        with self._lock:
+            for start in range(0, len(user_ids), 500):
+                chunk = [int(user_id) for user_id in user_ids[start : start + 500]]
+                placeholders = ", ".join("?" for _ in chunk)
+                cursor = self._index.execute(
+                    f"SELECT user_id, version, row FROM latest WHERE user_id IN ({placeholders})",
+                    chunk,
+                )
+                for user_id, version, row in cursor.fetchall():
+                    rows[user_id] = json.loads(row)
+                    rows[user_id]["version"] = version
+        return rows
+
+    def iter_latest(self) -> Iterator[dict]:
+        """
+        按user_id顺序遍历每个用户最新的一行结果
+        """
+        with self._lock:
+            rows = self._index.execute(
+                "SELECT row FROM latest ORDER BY user_id"
+            ).fetchall()
+        for (row,) in rows:
+            yield json.loads(row)
+
+    def load_version(self, version: int) -> Dict[int, dict]:
+        """
+        读取一个version的全部结果, 同一个用户写过多次时取最后写入的一行
+        """
+        partition = self._partition(version)
+        if not os.path.isdir(partition):
+            return {}
+        rows: Dict[int, dict] = {}
+        files = sorted(
+            os.path.join(partition, f)
+            for f in os.listdir(partition)
+            if f.endswith(".parquet")
+        )
+        for batch in ds.dataset(files, format="parquet").to_batches():
+            for row in batch.to_pylist():
+                rows[int(row["user_id"])] = row
+        return rows
+
+    def diff(self, old_version: int, new_version: int) -> List[dict]:
+        """
+        对比两个version, 返回每个变化字段的 user_id, field, old, new
+        只在一个version里出现的用户, 另一边的值为None
+        """
+        old_rows = self.load_version(old_version)
+        new_rows = self.load_version(new_version)
+        changes: List[dict] = []
+        for user_id in sorted(set(old_rows) | set(new_rows)):
+            old_row = old_rows.get(user_id, {})
+            new_row = new_rows.get(user_id, {})
+            for field in sorted(set(old_row) | set(new_row)):
+                if field == "user_id" or old_row.get(field) == new_row.get(field):
+                    continue
+                changes.append(
+                    {
+                        "user_id": user_id,
+                        "field": field,
+                        "old": old_row.get(field),
+                        "new": new_row.get(field),
+                    }
+                )
+        return changes
+
+    def export(self, output: str, version: Optional[int] = None) -> int:
+        """
+        导出某个version(默认每个用户最新的结果)到csv或parquet, 按文件后缀决定格式
+        """
+        if version is None:
+            rows = list(self.iter_latest())
+        else:
+            rows = list(self.load_version(version).values())
+        table = pa.Table.from_pylist(rows)
+        if output.endswith(".parquet"):
+            pq.write_table(table, output)
+        else:
+            pcsv.write_csv(table, output)
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._index.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="inspect the local results store")
+    parser.add_argument("--path", default="./results/store")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("versions")
+    get = sub.add_parser("get")
+    get.add_argument("user_id", type=int)
+    diff = sub.add_parser("diff")
+    diff.add_argument("old_version", type=int)
+    diff.add_argument("new_version", type=int)
+    export = sub.add_parser("export")
+    export.add_argument("output")
+    export.add_argument("--version", type=int, default=None)
+    args = parser.parse_args()
+
+    store = ResultStore(args.path)
+    if args.command == "versions":
+        print(store.versions())
+    elif args.command == "get":
+        print(store.get(args.user_id))
+    elif args.command == "diff":
+        for change in store.diff(args.old_version, args.new_version):
+            print(json.dumps(change, ensure_ascii=False))
+    elif args.command == "export":
+        print(
+            f"exported {store.export(args.output, args.version)} rows to {args.output}"
+        )
@@ -0,0 +1,110 @@
+from typing import List, Optional
+from datetime import datetime
+from schemas import HistorySummary, UserPrompt
+from prompts import estimate_tokens
+import os
+import sqlite3
+import threading
+
+
+class SummaryStore(object):
+    """
+    用户历史prompt滚动摘要的sqlite存储, 每个用户只保留最新的一份
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS summaries (
+              user_id INTEGER PRIMARY KEY,
+              summary TEXT NOT NULL,
+              watermark TEXT,
+              prompt_count INTEGER NOT NULL,
+              updated_at TEXT NOT NULL
+            )
+            """)
+        self._conn.commit()
+
+    def get(self, user_id: int) -> Optional[HistorySummary]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summary, watermark, prompt_count, updated_at FROM summaries WHERE user_id = ?",
+                (user_id,),
+            ).fetchone()
+        if not row:
+            return None
+        summary = HistorySummary(user_id=user_id)
+        summary.summary = row[0]
+        summary.watermark = datetime.fromisoformat(row[1]) if row[1] else None
+        summary.prompt_count = row[2]
+        summary.updated_at = datetime.fromisoformat(row[3])
+        return summary
+
+    def put(self, summary: HistorySummary):
+        summary.updated_at = summary.updated_at or datetime.now()
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO summaries (user_id, summary, watermark, prompt_count, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                  summary = excluded.summary,
+                  watermark = excluded.watermark,
+                  prompt_count = excluded.prompt_count,
+                  updated_at = excluded.updated_at
+                """,
+                (
+                    summary.user_id,
+                    summary.summary,
+                    summary.watermark.isoformat() if summary.watermark else None,
+                    summary.prompt_count,
+                    summary.updated_at.isoformat(),
+                ),
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def newer_prompts(
+    records: List[UserPrompt], summary: Optional[HistorySummary]
+) -> List[UserPrompt]:
+    """
+    records按最近使用时间倒序, 返回水位线之后的prompt; 没有摘要时全部都是新的
+    """
+    if summary is None:
+        return records
+    if summary.watermark is None:
+        return []
+    return [r for r in records if r.created_at and r.created_at > summary.watermark]
+
+
+def watermark(records: List[UserPrompt]) -> Optional[datetime]:
+    times = [r.created_at for r in records if r.created_at]
+    return max(times) if times else None
+
+
+def chunk_prompts(prompts: List[str], max_tokens: int) -> List[List[str]]:
+    """
+    按估算的token数把prompt分成若干批, 每批不超过max_tokens(单条超过时单独一批)
+    """
+    batches: List[List[str]] = []
+    batch: List[str] = []
+    used = 0
+    for prompt in prompts:
+        tokens = estimate_tokens(prompt)
+        if batch and used + tokens > max_tokens:
+            batches.append(batch)
+            batch, used = [], 0
+        batch.append(prompt)
+        used += tokens
+    if batch:
+        batches.append(batch)
+    return batches
@@ -0,0 +1,12 @@
+from typing import Iterator, List, TypeVar
+
+T = TypeVar("T")
+
+
+def chunks(items: List[T], size: int) -> Iterator[List[T]]:
+    """
+    把列表按size切分成多个批次
+    """
+    size = max(size, 1)
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
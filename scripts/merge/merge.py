@@ -1,80 +1,237 @@
+import argparse
 import csv
-from typing import List
+import json
+import os
+import time
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
 from openpyxl import load_workbook
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-user_profiles = {}
-user_results = {}
+# user_profiles.xlsx 里 email 和人工标注 predict 所在的列
+EMAIL_COLUMN = 0
+PREDICT_COLUMN = 19
 
 
-def read_csv_file(filepath: str):
+def read_csv_file(filepath: str) -> Iterator[List[str]]:
     """
-    读取 CSV 文件并返回列表形式的数据（含表头）
+    流式读取 CSV 文件, 逐行返回（含表头）
     """
     with open(filepath, newline="", encoding="utf-8") as csvfile:
         reader = csv.reader(csvfile)
-        data = [row for row in reader]
-    return data
+        for row in reader:
+            yield row
 
 
-def read_xlsx_file(filepath):
+def read_xlsx_file(filepath) -> Iterator[tuple]:
     """
-    读取 XLSX 文件并返回列表形式的数据（含表头），默认读取第一个工作表
+    以只读流式模式读取 XLSX 文件, 逐行返回（含表头）, 默认读取第一个工作表
     """
-    workbook = load_workbook(filename=filepath)
-    sheet = workbook.active
-    data = []
-    for row in sheet.iter_rows(values_only=True):
-        data.append(list(row))
-    return data
+    workbook = load_workbook(filename=filepath, read_only=True, data_only=True)
+    try:
+        sheet = workbook.active
+        for row in sheet.iter_rows(values_only=True):
+            yield row
+    finally:
+        workbook.close()
 
 
-def load_user_profiles():
-    data = read_xlsx_file("../sources/google/user_profiles.xlsx")
-    for i in range(len(data)):
-        if i == 0:
+def profiles_cache_path(filepath: str) -> str:
+    return f"{filepath}.profiles.parquet"
+
+
+def manifest_path(output_path: str) -> str:
+    return f"{output_path}.manifest.json"
+
+
+def file_signature(filepath: str) -> Dict[str, object]:
+    """
+    用绝对路径 + 大小 + 修改时间标识一个输入文件
+    """
+    stat = os.stat(filepath)
+    return {
+        "path": os.path.abspath(filepath),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def cached_profiles(cache_path: str, source: Dict[str, object]) -> Optional[pa.Table]:
+    """
+    parquet 缓存的 metadata 里记录了生成它的 xlsx, 和当前的 xlsx 一致时才复用
+    """
+    if not os.path.exists(cache_path):
+        return None
+    metadata = pq.read_schema(cache_path).metadata or {}
+    if metadata.get(b"source") != json.dumps(source, sort_keys=True).encode():
+        return None
+    return pq.read_table(cache_path)
+
+
+def load_user_profiles(filepath: str) -> pa.Table:
+    """
+    读取 (email, predict) 两列, 优先使用 xlsx 对应的 parquet 缓存, xlsx 有变化时重新生成
+    """
+    cache_path = profiles_cache_path(filepath)
+    source = file_signature(filepath)
+    table = cached_profiles(cache_path, source)
+    if table is not None:
+        return table
+
+    emails: List[Optional[str]] = []
+    predicts: List[Optional[str]] = []
+    for row in islice(read_xlsx_file(filepath), 1, None):
+        if not row or len(row) <= PREDICT_COLUMN:
             continue
-        user_profiles[data[i][0]] = data[i][19]
+        emails.append(None if row[EMAIL_COLUMN] is None else str(row[EMAIL_COLUMN]))
+        predicts.append(
+            None if row[PREDICT_COLUMN] is None else str(row[PREDICT_COLUMN])
+        )
+    table = pa.table(
+        {
+            "email": pa.array(emails, pa.string()),
+            "predict": pa.array(predicts, pa.string()),
+        },
+        metadata={"source": json.dumps(source, sort_keys=True)},
+    )
+    pq.write_table(table, cache_path)
+    print(f"Parquet 缓存已创建：{cache_path}")
+    return table
+
+
+def estimate_csv_rows(filepath: str, sample: int = 1000) -> int:
+    """
+    用前 sample 行的平均长度估算 CSV 的行数
+    """
+    size = os.path.getsize(filepath)
+    with open(filepath, "rb") as f:
+        lines = list(islice(f, sample))
+    if not lines:
+        return 0
+    if len(lines) < sample:
+        return len(lines)
+    return int(size / (sum(len(line) for line in lines) / len(lines)))
 
 
-def load_user_results():
-    data = read_csv_file("../results/results.csv")
-    for i in range(len(data)):
-        if i == 0:
-            header = data[i]
+def format_row(row: List[str], predict: Optional[str]) -> List[Optional[str]]:
+    values: List[Optional[str]] = ["-" if v == "<nil>" else v for v in row]
+    values.append("-" if predict == "<nil>" else predict)
+    return values
+
+
+def last_result_rows(results_path: str, emails) -> Dict[str, int]:
+    """
+    emails 中每个 email 在 results 里最后出现的行号(不含表头), 内存只和 emails 的数量有关
+    """
+    last: Dict[str, int] = {}
+    for number, row in enumerate(islice(read_csv_file(results_path), 1, None)):
+        if len(row) > 1 and row[1] in emails:
+            last[row[1]] = number
+    return last
+
+
+def join_index_profiles(profiles: pa.Table, results_path: str, writer) -> int:
+    """
+    profiles 较小: 对 profiles 建 email 索引, 扫描两遍 results
+    和原来的 dict 一样两边都是后出现的行覆盖先出现的, 每个 email 只输出一行
+    """
+    emails = profiles.column("email").to_pylist()
+    predicts = profiles.column("predict").to_pylist()
+    index: Dict[str, Optional[str]] = dict(zip(emails, predicts))
+    last = last_result_rows(results_path, index)
+    count = 0
+    for number, row in enumerate(islice(read_csv_file(results_path), 1, None)):
+        if len(row) <= 1 or last.get(row[1]) != number:
             continue
-        user_results[data[i][1]] = data[i]
-    return header
+        writer.writerow(format_row(row, index[row[1]]))
+        count += 1
+    return count
 
 
-def merge():
-    load_user_profiles()
-    header = load_user_results()
+def join_index_results(profiles: pa.Table, results_path: str, writer) -> int:
+    """
+    results 较小: 对 results 建 email 索引, 按批流式扫描 profiles
+    profiles 里重复的 email 取最后一个 predict, 按第一次出现的顺序每个 email 只输出一行
+    """
+    index: Dict[str, List[str]] = {}
+    for row in islice(read_csv_file(results_path), 1, None):
+        if len(row) > 1:
+            index[row[1]] = row
+    matched: Dict[str, Optional[str]] = {}
+    for batch in profiles.to_batches():
+        for email, predict in zip(
+            batch.column(0).to_pylist(), batch.column(1).to_pylist()
+        ):
+            if email in index:
+                matched[email] = predict
+    for email, predict in matched.items():
+        writer.writerow(format_row(index[email], predict))
+    return len(matched)
+
+
+def merge(
+    profiles_path: str = "../sources/google/user_profiles.xlsx",
+    results_path: str = "../results/results.csv",
+    output_path: str = "./merge.csv",
+    force: bool = False,
+) -> Tuple[str, int]:
+    """
+    按 email 关联人工标注和预测结果, 对较小的一边建索引, 另一边流式扫描并直接写出
+    输出旁边的 manifest 记录了生成它的两个输入, 输入(路径, 大小, 修改时间)都没有变化时直接复用上次的输出
+    """
+    manifest = {
+        "profiles": file_signature(profiles_path),
+        "results": file_signature(results_path),
+    }
+    if not force and os.path.exists(output_path):
+        try:
+            with open(manifest_path(output_path), encoding="utf-8") as f:
+                unchanged = json.load(f) == manifest
+        except (OSError, ValueError):
+            unchanged = False
+        if unchanged:
+            print(f"输入没有变化, 跳过：{output_path}")
+            return output_path, -1
+
+    # 先删掉旧的 manifest, 写到一半中断时下次不会误用不完整的输出
+    if os.path.exists(manifest_path(output_path)):
+        os.remove(manifest_path(output_path))
+    profiles = load_user_profiles(profiles_path)
+    header = next(read_csv_file(results_path))
     header.append("predict")
-    # print("--", header)
-    # print("++", user_profiles["atsatsj0135798@gmail.com"])
-    # print("xx", user_results["atsatsj0135798@gmail.com"])
-    rows = []
-    for k, v in user_profiles.items():
-        if k not in user_results:
-            continue
-        user_results[k].append(v)
-        row = list()
-        for v in user_results[k]:
-            if v == "<nil>":
-                v = "-"
-            row.append(v)
-        rows.append(row)
-    create_csv_file("./merge.csv", header, rows)
-
-
-def create_csv_file(filepath, header, rows):
-    with open(filepath, "w", newline="", encoding="utf-8") as csvfile:
+
+    with open(output_path, "w", newline="", encoding="utf-8") as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow(header)
-        writer.writerows(rows)
-
-    print(f"CSV 文件已创建：{filepath}")
+        if profiles.num_rows <= estimate_csv_rows(results_path):
+            count = join_index_profiles(profiles, results_path, writer)
+        else:
+            count = join_index_results(profiles, results_path, writer)
+
+    with open(manifest_path(output_path), "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    print(f"CSV 文件已创建：{output_path}, rows: {count}")
+    return output_path, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="merge labelled profiles and results")
+    parser.add_argument("--profiles", default="../sources/google/user_profiles.xlsx")
+    parser.add_argument("--results", default="../results/results.csv")
+    parser.add_argument("--output", default="./merge.csv")
+    parser.add_argument("--force", action="store_true", help="ignore cached output")
+    args = parser.parse_args()
+
+    start = time.time()
+    merge(
+        profiles_path=args.profiles,
+        results_path=args.results,
+        output_path=args.output,
+        force=args.force,
+    )
+    print(f"cost: {time.time() - start:.2f}s")
 
 
 if __name__ == "__main__":
-    merge()
+    main()
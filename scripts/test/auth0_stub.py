@@ -0,0 +1,117 @@
+# Local Auth0 stub server to measure the throughput of fetch_data's Auth0 enrichment
+#
+#   python auth0_stub.py --emails 2000 --workers 16 --rate-limit 50 --latency 0.05
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class Auth0Stub(BaseHTTPRequestHandler):
+    latency = 0.05
+    rate_limit = 50  # requests per second
+    token_requests = 0
+    lookups = 0
+    throttled = 0
+    _lock = threading.Lock()
+    _window_start = 0
+    _window_count = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        if self.path == "/oauth/token":
+            with Auth0Stub._lock:
+                Auth0Stub.token_requests += 1
+            self._send(200, {"access_token": "stub-token", "expires_in": 86400})
+            return
+        self._send(404, {})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/api/v2/users-by-email":
+            self._send(404, {})
+            return
+
+        now = int(time.time())
+        with Auth0Stub._lock:
+            if now != Auth0Stub._window_start:
+                Auth0Stub._window_start = now
+                Auth0Stub._window_count = 0
+            Auth0Stub._window_count += 1
+            remaining = Auth0Stub.rate_limit - Auth0Stub._window_count
+        headers = {
+            "X-RateLimit-Limit": str(Auth0Stub.rate_limit),
+            "X-RateLimit-Remaining": str(max(remaining, 0)),
+            "X-RateLimit-Reset": str(now + 1),
+        }
+        if remaining < 0:
+            with Auth0Stub._lock:
+                Auth0Stub.throttled += 1
+            self._send(429, {"error": "too_many_requests"}, headers)
+            return
+
+        time.sleep(Auth0Stub.latency)
+        email = parse_qs(url.query).get("email", [""])[0]
+        with Auth0Stub._lock:
+            Auth0Stub.lookups += 1
+        self._send(200, [{"user_id": f"auth0|{email}", "email": email, "name": email}], headers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Auth0 enrichment throughput against a local stub")
+    parser.add_argument("--emails", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--rate-limit", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--port", type=int, default=8099)
+    args = parser.parse_args()
+
+    Auth0Stub.rate_limit = args.rate_limit
+    Auth0Stub.latency = args.latency
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), Auth0Stub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    os.environ.update(
+        {
+            "AUTH0_DOMAIN": "stub.auth0.local",
+            "AUTH0_CLIENT_ID": "stub",
+            "AUTH0_CLIENT_SECRET": "stub",
+            "AUTH0_BASE_URL": f"http://127.0.0.1:{args.port}",
+        }
+    )
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "yuhao"))
+    import pandas as pd
+    from fetch_data import enrich_with_auth0_data
+
+    df = pd.DataFrame({"email": [f"user{i}@example.com" for i in range(args.emails)]})
+    start = time.time()
+    enriched = enrich_with_auth0_data(df, max_workers=args.workers)
+    elapsed = time.time() - start
+    server.shutdown()
+
+    found = enriched["auth0.user_id"].notna().sum() if "auth0.user_id" in enriched else 0
+    print(f"enriched {found}/{args.emails} emails in {elapsed:.2f}s ({args.emails / elapsed:.1f}/s)")
+    print(f"token requests: {Auth0Stub.token_requests}, lookups: {Auth0Stub.lookups}, throttled: {Auth0Stub.throttled}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,13 +9,26 @@ import concurrent.futures
 import time
 from datetime import datetime
 import json
+import gzip
+import io
+import base64
+import hashlib
+import threading
 
 # import stripe  # Temporarily disabled
 from typing import Dict, List, Optional
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlencode
 
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -23,26 +36,242 @@ load_dotenv()
 AUTH0_DOMAIN = os.getenv("AUTH0_DOMAIN")
 AUTH0_CLIENT_ID = os.getenv("AUTH0_CLIENT_ID")
 AUTH0_CLIENT_SECRET = os.getenv("AUTH0_CLIENT_SECRET")
+# Override to point at a local stub server, e.g. http://127.0.0.1:8099
+AUTH0_BASE_URL = os.getenv("AUTH0_BASE_URL") or f"https://{AUTH0_DOMAIN}"
 
 
-def get_auth0_token():
-    """Get Auth0 Management API access token."""
-    url = f"https://{AUTH0_DOMAIN}/oauth/token"
-    headers = {"content-type": "application/x-www-form-urlencoded"}
-    data = {
-        "grant_type": "client_credentials",
-        "client_id": AUTH0_CLIENT_ID,
-        "client_secret": AUTH0_CLIENT_SECRET,
-        "audience": f"https://{AUTH0_DOMAIN}/api/v2/",
+class Auth0Client:
+    """Auth0 Management API client.
+
+    Reuses one access token until shortly before it expires, sends requests over a
+    pooled session and honours the X-RateLimit-* / Retry-After headers, so lookups
+    can run concurrently without tripping the rate limit.
+    """
+
+    def __init__(
+        self, base_url: Optional[str] = None, max_workers: int = 8, max_retries: int = 5
+    ):
+        self.base_url = (base_url or AUTH0_BASE_URL).rstrip("/")
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._token: Optional[str] = None
+        self._token_expires_at = 0.0
+        self._token_lock = threading.Lock()
+        self._rate_lock = threading.Lock()
+        self._paused_until = 0.0
+
+    def token(self, refresh: bool = False) -> Optional[str]:
+        """Get a Management API access token, cached until 60s before it expires."""
+        with self._token_lock:
+            if (
+                not refresh
+                and self._token
+                and time.time() < self._token_expires_at - 60
+            ):
+                return self._token
+
+            url = f"{self.base_url}/oauth/token"
+            headers = {"content-type": "application/x-www-form-urlencoded"}
+            data = {
+                "grant_type": "client_credentials",
+                "client_id": AUTH0_CLIENT_ID,
+                "client_secret": AUTH0_CLIENT_SECRET,
+                "audience": f"https://{AUTH0_DOMAIN}/api/v2/",
+            }
+            try:
+                response = self._session.post(
+                    url, headers=headers, data=urlencode(data), timeout=10
+                )
+                response.raise_for_status()
+                body = response.json()
+                self._token = body["access_token"]
+                self._token_expires_at = time.time() + body.get("expires_in", 86400)
+                return self._token
+            except Exception as e:
+                print(f"Error getting Auth0 token: {e}")
+                self._token = None
+                return None
+
+    def _wait_for_rate_limit(self):
+        with self._rate_lock:
+            delay = self._paused_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _update_rate_limit(self, response):
+        """Pause all workers until the reset time once the limit is used up."""
+        paused_until = 0.0
+        if response.status_code == 429:
+            retry_after = response.headers.get("Retry-After")
+            reset = response.headers.get("X-RateLimit-Reset")
+            if retry_after:
+                paused_until = time.time() + float(retry_after)
+            elif reset:
+                paused_until = float(reset)
+            else:
+                paused_until = time.time() + 1
+        elif response.headers.get("X-RateLimit-Remaining") == "0":
+            reset = response.headers.get("X-RateLimit-Reset")
+            if reset:
+                paused_until = float(reset)
+        if paused_until:
+            with self._rate_lock:
+                self._paused_until = max(self._paused_until, paused_until)
+
+    def request(self, method: str, path: str, **kwargs):
+        """Send an authorized request, retrying on 429 and refreshing the token on 401."""
+        refresh = False
+        for _ in range(self.max_retries):
+            token = self.token(refresh=refresh)
+            if not token:
+                return None
+            self._wait_for_rate_limit()
+            headers = {
+                "Authorization": f"Bearer {token}",
+                "Content-Type": "application/json",
+            }
+            response = self._session.request(
+                method, f"{self.base_url}{path}", headers=headers, timeout=30, **kwargs
+            )
+            self._update_rate_limit(response)
+            if response.status_code == 429:
+                continue
+            if response.status_code == 401 and not refresh:
+                refresh = True
+                continue
+            response.raise_for_status()
+            return response
+        raise RuntimeError(
+            f"Auth0 {method} {path} failed after {self.max_retries} attempts"
+        )
+
+    def get_user_data(self, email: str) -> Dict:
+        """Get user data from Auth0."""
+        try:
+            response = self.request(
+                "GET", "/api/v2/users-by-email", params={"email": email}
+            )
+            if response is None:
+                return {}
+            users = response.json()
+            if not users:
+                return {}
+            # Get the first user (most relevant)
+            return format_auth0_user(users[0])
+        except Exception as e:
+            print(f"Error getting Auth0 data for {email}: {e}")
+            return {}
+
+    def get_users_data(self, emails: List[str]) -> Dict[str, Dict]:
+        """Look up many emails concurrently, bounded by max_workers."""
+        results: Dict[str, Dict] = {}
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers
+        ) as executor:
+            future_to_email = {
+                executor.submit(self.get_user_data, email): email for email in emails
+            }
+            for future in concurrent.futures.as_completed(future_to_email):
+                user_data = future.result()
+                if user_data:
+                    results[future_to_email[future]] = user_data
+        return results
+
+    def export_users_data(
+        self, emails: List[str], poll_interval: float = 5, timeout: float = 1800
+    ) -> Dict[str, Dict]:
+        """Fetch users through the bulk user-export job instead of one lookup per email."""
+        fields = [
+            "user_id",
+            "email",
+            "name",
+            "nickname",
+            "created_at",
+            "last_login",
+            "logins_count",
+            "email_verified",
+            "user_metadata",
+            "app_metadata",
+            "identities",
+        ]
+        response = self.request(
+            "POST",
+            "/api/v2/jobs/users-exports",
+            json={"format": "json", "fields": [{"name": f} for f in fields]},
+        )
+        if response is None:
+            return {}
+        job_id = response.json()["id"]
+
+        deadline = time.time() + timeout
+        while True:
+            response = self.request("GET", f"/api/v2/jobs/{job_id}")
+            if response is None:
+                print(f"Auth0 export job {job_id} could not be polled")
+                return {}
+            job = response.json()
+            if job.get("status") == "completed":
+                break
+            if job.get("status") == "failed" or time.time() > deadline:
+                print(
+                    f"Auth0 export job {job_id} did not complete: {job.get('status')}"
+                )
+                return {}
+            time.sleep(poll_interval)
+
+        wanted = set(emails)
+        results: Dict[str, Dict] = {}
+        # stream the (usually gzipped) export line by line instead of buffering it
+        with self._session.get(job["location"], timeout=300, stream=True) as download:
+            download.raise_for_status()
+            download.raw.decode_content = True
+            # keep raw readable at EOF so GzipFile can check the trailer
+            download.raw.auto_close = False
+            stream = io.BufferedReader(download.raw)
+            if stream.peek(2)[:2] == b"\x1f\x8b":
+                stream = gzip.GzipFile(fileobj=stream)
+            for line in stream:
+                if not line.strip():
+                    continue
+                user = json.loads(line)
+                email = user.get("email")
+                if email in wanted and email not in results:
+                    results[email] = format_auth0_user(user)
+        return results
+
+
+def format_auth0_user(user: Dict) -> Dict:
+    return {
+        "auth0.user_id": user.get("user_id", ""),
+        "auth0.name": user.get("name", ""),
+        "auth0.nickname": user.get("nickname", ""),
+        "auth0.created_at": user.get("created_at", ""),
+        "auth0.last_login": user.get("last_login", ""),
+        "auth0.logins_count": user.get("logins_count", 0),
+        "auth0.email_verified": user.get("email_verified", False),
+        "auth0.user_metadata": json.dumps(user.get("user_metadata", {})),
+        "auth0.app_metadata": json.dumps(user.get("app_metadata", {})),
+        "auth0.identities": json.dumps(user.get("identities", [])),
     }
 
-    try:
-        response = requests.post(url, headers=headers, data=urlencode(data))
-        response.raise_for_status()
-        return response.json()["access_token"]
-    except Exception as e:
-        print(f"Error getting Auth0 token: {e}")
-        return None
+
+_auth0_client: Optional[Auth0Client] = None
+
+
+def get_auth0_client(max_workers: int = 8) -> Auth0Client:
+    global _auth0_client
+    if _auth0_client is None or _auth0_client.max_workers != max_workers:
+        _auth0_client = Auth0Client(max_workers=max_workers)
+    return _auth0_client
+
+
+def get_auth0_token():
+    """Get Auth0 Management API access token."""
+    return get_auth0_client().token()
 
 
 def get_auth0_data(email: str) -> Dict:
@@ -50,51 +279,27 @@ def get_auth0_data(email: str) -> Dict:
     if not all([AUTH0_DOMAIN, AUTH0_CLIENT_ID, AUTH0_CLIENT_SECRET]):
         print("Auth0 configuration missing")
         return {}
+    return get_auth0_client().get_user_data(email)
 
-    token = get_auth0_token()
-    if not token:
-        return {}
-
-    url = f"https://{AUTH0_DOMAIN}/api/v2/users-by-email"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    params = {"email": email}
-
-    try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        users = response.json()
 
-        if not users:
-            return {}
-
-        # Get the first user (most relevant)
-        user = users[0]
-        auth0_data = {
-            "auth0.user_id": user.get("user_id", ""),
-            "auth0.name": user.get("name", ""),
-            "auth0.nickname": user.get("nickname", ""),
-            "auth0.created_at": user.get("created_at", ""),
-            "auth0.last_login": user.get("last_login", ""),
-            "auth0.logins_count": user.get("logins_count", 0),
-            "auth0.email_verified": user.get("email_verified", False),
-            "auth0.user_metadata": json.dumps(user.get("user_metadata", {})),
-            "auth0.app_metadata": json.dumps(user.get("app_metadata", {})),
-            "auth0.identities": json.dumps(user.get("identities", [])),
-        }
-        return auth0_data
-    except Exception as e:
-        print(f"Error getting Auth0 data for {email}: {e}")
-        return {}
+def enrich_with_auth0_data(df, max_workers: int = 8, export_threshold: int = 5000):
+    """Enrich DataFrame with Auth0 user data.
 
+    Emails are looked up concurrently; lists larger than export_threshold go
+    through the bulk user-export job instead.
+    """
+    if not all([AUTH0_DOMAIN, AUTH0_CLIENT_ID, AUTH0_CLIENT_SECRET]):
+        print("Auth0 configuration missing")
+        return df
 
-def enrich_with_auth0_data(df):
-    """Enrich DataFrame with Auth0 user data."""
-    auth0_data = []
-    for email in df["email"].unique():
-        user_data = get_auth0_data(email)
-        if user_data:
-            auth0_data.append({"email": email, **user_data})
+    emails = df["email"].dropna().unique().tolist()
+    client = get_auth0_client(max_workers=max_workers)
+    if export_threshold and len(emails) > export_threshold:
+        users = client.export_users_data(emails)
+    else:
+        users = client.get_users_data(emails)
 
+    auth0_data = [{"email": email, **user_data} for email, user_data in users.items()]
     if not auth0_data:
         return df
 
@@ -153,16 +358,75 @@ def read_email_list(csv_path):
         return []
 
 
-def query_user_data(emails, client):
-    """Query prompts and results for the given emails."""
+def chunked(items: List, size: int) -> List[List]:
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def run_query(query, client) -> pd.DataFrame:
+    """Run a query and read the result through the BigQuery Storage API into an Arrow-backed frame."""
+    rows = client.query(query).result()
+    return rows.to_arrow(create_bqstorage_client=True).to_pandas(
+        types_mapper=pd.ArrowDtype
+    )
+
+
+def run_query_with_retries(query, client, retries=2, backoff=2.0) -> pd.DataFrame:
+    """Run a query, retrying up to retries more times with exponential backoff."""
+    for attempt in range(retries + 1):
+        try:
+            return run_query(query, client)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            print(f"Query failed (attempt {attempt + 1}/{retries + 1}): {e}")
+            time.sleep(backoff * 2**attempt)
+
+
+def query_in_chunks(
+    emails, client, build_query, chunk_size=500, max_workers=4, retries=2
+) -> pd.DataFrame:
+    """Split emails into chunks, run build_query(chunk) for each in parallel and concat the results.
+
+    Each chunk is retried up to retries times; if any chunk still fails, a
+    RuntimeError is raised instead of returning partial results.
+    """
+    frames = []
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_chunk = {
+            executor.submit(
+                run_query_with_retries, build_query(chunk), client, retries
+            ): chunk
+            for chunk in chunked(emails, chunk_size)
+        }
+        for future in concurrent.futures.as_completed(future_to_chunk):
+            chunk = future_to_chunk[future]
+            try:
+                frames.append(future.result())
+            except Exception as e:
+                print(f"Error querying chunk of {len(chunk)} emails: {e}")
+                failed.append(e)
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)}/{len(future_to_chunk)} email chunks failed after {retries} retries"
+        ) from failed[0]
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+
+def email_in_clause(emails) -> str:
+    return ", ".join(sql_quote(email) for email in emails if "\\" not in email)
+
+
+def query_user_data(emails, client, chunk_size=500, max_workers=4):
+    """Query prompts and results for the given emails, chunk by chunk in parallel."""
     if not emails:
         print("No emails to query")
         return pd.DataFrame()
 
-    # Format emails for SQL IN clause
-    email_list = "', '".join(emails)
-
-    query = f"""
+    def build_query(chunk):
+        return f"""
     SELECT * FROM EXTERNAL_QUERY("kuse-ai.us.kuse-ai-main", 
         \"\"\"
         WITH RankedTasks AS (
@@ -177,7 +441,7 @@ def query_user_data(emails, client):
                 ROW_NUMBER() OVER (PARTITION BY u.email ORDER BY t.created_at DESC) as rn
             FROM tasks t 
             JOIN user u ON t.user_id = u.id 
-            WHERE u.email IN ('{email_list}')
+            WHERE u.email IN ({email_in_clause(chunk)})
         )
         SELECT 
             id,
@@ -192,18 +456,59 @@ def query_user_data(emails, client):
         \"\"\");
     """
 
-    try:
-        query_job = client.query(query)
-        results_df = query_job.to_dataframe()
-        print(f"Retrieved {len(results_df)} tasks for {len(emails)} users")
-        return results_df
-    except Exception as e:
-        print(f"Error querying user data: {e}")
+    results_df = query_in_chunks(emails, client, build_query, chunk_size, max_workers)
+    print(f"Retrieved {len(results_df)} tasks for {len(emails)} users")
+    return results_df
+
+
+def query_user_profiles(emails, client, chunk_size=1000, max_workers=4):
+    """Query only email and image_url for the given emails."""
+    if not emails:
+        print("No emails to query")
         return pd.DataFrame()
 
+    def build_query(chunk):
+        return f"""
+    SELECT * FROM EXTERNAL_QUERY("kuse-ai.us.kuse-ai-main",
+        \"\"\"
+        SELECT email, image_url
+        FROM user
+        WHERE email IN ({email_in_clause(chunk)})
+        \"\"\");
+    """
 
-def download_file(row, user_dir, storage_client):
-    """Download a single file. Used for parallel downloading."""
+    profiles_df = query_in_chunks(emails, client, build_query, chunk_size, max_workers)
+    print(f"Retrieved {len(profiles_df)} profiles for {len(emails)} users")
+    return profiles_df
+
+
+def sql_quote(value: str) -> str:
+    """Quote a string for a MySQL literal inside EXTERNAL_QUERY."""
+    return "'" + value.replace("'", "''") + "'"
+
+
+def md5_base64(path: str) -> str:
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return base64.b64encode(digest.digest()).decode("ascii")
+
+
+def local_filename(filename: str, filepath: str) -> str:
+    """Prefix the original filename with the object id, e.g. u1231214_report.pdf."""
+    file_id = os.path.splitext(os.path.basename(filepath))[0]
+    return f"{file_id}_{os.path.basename(filename)}"
+
+
+def download_file(row, user_dir, storage_client, verify_md5=False):
+    """Download a single file. Used for parallel downloading.
+
+    Local files are named after the storage object (see local_filename), so two
+    uploads with the same filename never share a path. Files already on disk with
+    the expected size (and MD5, if verify_md5) are skipped; downloads go to a .part
+    file first so an interrupted run never leaves a truncated file behind.
+    """
     try:
         filename = row["filename"]
         filepath = row["filepath"]  # e.g upload/u1231214.pdf
@@ -213,79 +518,92 @@ def download_file(row, user_dir, storage_client):
         bucket_name = "smart-design-assets"
         blob_path = filepath
         bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(blob_path)
 
-        destination_path = os.path.join(user_dir, filename)
-        blob.download_to_filename(destination_path)
+        destination_path = os.path.join(user_dir, local_filename(filename, filepath))
+        if (
+            os.path.exists(destination_path)
+            and os.path.getsize(destination_path) == file_size
+        ):
+            if not verify_md5:
+                return True, f"Skipped {filename} (size matches)"
+            blob = bucket.get_blob(blob_path)
+            if blob is not None and blob.md5_hash == md5_base64(destination_path):
+                return True, f"Skipped {filename} (md5 matches)"
+
+        blob = bucket.blob(blob_path)
+        part_path = destination_path + ".part"
+        blob.download_to_filename(part_path)
+        os.replace(part_path, destination_path)
         return True, f"Downloaded {filename} ({file_size} bytes)"
     except Exception as e:
         return False, f"Error downloading {row.get('filename', 'unknown')}: {e}"
 
 
+def query_user_files(emails, client, limit=20, chunk_size=500, max_workers=4):
+    """Query the most recent files of every email, one query per chunk of emails."""
+
+    def build_query(chunk):
+        return f"""
+    SELECT * FROM EXTERNAL_QUERY("kuse-ai.us.kuse-ai-main",
+        \"\"\"
+        SELECT email, filename, filepath, file_size
+        FROM (
+            SELECT
+                i.email,
+                f.filename,
+                f.filepath,
+                f.file_size,
+                ROW_NUMBER() OVER (PARTITION BY i.email ORDER BY f.created_at DESC) AS rn
+            FROM files f
+            JOIN user i ON f.user_id = i.id
+            WHERE i.email IN ({email_in_clause(chunk)})
+        ) AS ranked
+        WHERE rn <= {int(limit)}
+        \"\"\");
+    """
+
+    return query_in_chunks(emails, client, build_query, chunk_size, max_workers)
+
+
 def query_and_download_files(
-    emails, client, storage_client, output_dir, max_workers=10
+    emails, client, storage_client, output_dir, max_workers=10, verify_md5=False
 ):
-    """Query and download input files for the given emails in parallel."""
+    """Query the files of all emails at once and download them through one shared pool."""
     if not emails:
         print("No emails to query for files")
         return
 
     start_time = time.time()
-    total_files = 0
     successful_downloads = 0
 
-    for email in emails:
-        try:
-            # Query files for this user
-            query = f"""
-            SELECT * FROM EXTERNAL_QUERY("kuse-ai.us.kuse-ai-main",
-                \"\"\"
-                SELECT filename, filepath, file_size 
-                FROM files f 
-                JOIN user i ON f.user_id = i.id 
-                WHERE i.email = '{email}'
-                ORDER BY f.created_at DESC
-                LIMIT 20
-                \"\"\");
-            """
-
-            query_job = client.query(query)
-            files_df = query_job.to_dataframe()
-
-            if files_df.empty:
-                print(f"No files found for {email}")
-                continue
+    files_df = query_user_files(emails, client)
+    if files_df.empty:
+        print("No files found")
+        return
 
-            file_count = len(files_df)
-            total_files += file_count
-            print(f"Found {file_count} files for {email}")
+    total_files = len(files_df)
+    print(
+        f"Found {total_files} files for {files_df['email'].nunique()}/{len(emails)} emails"
+    )
 
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_file = {}
+        for email, user_files in files_df.groupby("email"):
             # Create directory for this user's files
             user_dir = os.path.join(output_dir, email.replace("@", "_at_"))
             os.makedirs(user_dir, exist_ok=True)
-
-            # Download files in parallel
-            with concurrent.futures.ThreadPoolExecutor(
-                max_workers=max_workers
-            ) as executor:
-                # Create a list of future tasks
-                future_to_file = {
-                    executor.submit(download_file, row, user_dir, storage_client): row[
-                        "filename"
-                    ]
-                    for _, row in files_df.iterrows()
-                }
-
-                # Process results as they complete
-                for future in concurrent.futures.as_completed(future_to_file):
-                    filename = future_to_file[future]
-                    success, message = future.result()
-                    if success:
-                        successful_downloads += 1
-                    print(message)
-
-        except Exception as e:
-            print(f"Error processing files for {email}: {e}")
+            for _, row in user_files.iterrows():
+                future = executor.submit(
+                    download_file, row, user_dir, storage_client, verify_md5
+                )
+                future_to_file[future] = row["filename"]
+
+        # Process results as they complete
+        for future in concurrent.futures.as_completed(future_to_file):
+            success, message = future.result()
+            if success:
+                successful_downloads += 1
+            print(message)
 
     elapsed_time = time.time() - start_time
     print(
@@ -294,67 +612,89 @@ def query_and_download_files(
     )
 
 
-def flatten_task_data(df):
-    """Flatten the task data by extracting specified fields from JSON."""
-    # Create a copy of the dataframe
-    flattened = df.copy()
+TASK_META_FIELDS = [
+    "prompt",
+    "file_ids",
+    "texts",
+    "urls",
+    "image_urls",
+    "video_ids",
+    "selected_text",
+    "mention_agents",
+]
+RESULT_META_FIELDS = ["markdown"]
+
+
+def parse_meta(x) -> Dict:
+    """Decode a task_meta/result_meta blob once, unwrapping double-encoded JSON strings."""
+    if isinstance(x, dict):
+        return x
+    for _ in range(2):
+        if not isinstance(x, (str, bytes)):
+            break
+        try:
+            x = json_loads(x)
+        except ValueError:
+            return {}
+    return x if isinstance(x, dict) else {}
 
-    def extract_field(x, field):
-        """Extract field from task_meta or result_meta."""
-        if pd.isnull(x):
-            return None
-        if isinstance(x, dict):
-            return x.get(field)
-        if isinstance(x, str):
-            try:
-                return json.loads(x).get(field)
-            except json.JSONDecodeError:
-                return None
-        return None
 
-    # Extract fields from task_meta
-    flattened["prompt"] = df["task_meta"].apply(lambda x: extract_field(x, "prompt"))
-    flattened["file_ids"] = df["task_meta"].apply(
-        lambda x: extract_field(x, "file_ids")
-    )
-    flattened["texts"] = df["task_meta"].apply(lambda x: extract_field(x, "texts"))
-    flattened["urls"] = df["task_meta"].apply(lambda x: extract_field(x, "urls"))
-    flattened["image_urls"] = df["task_meta"].apply(
-        lambda x: extract_field(x, "image_urls")
-    )
-    flattened["video_ids"] = df["task_meta"].apply(
-        lambda x: extract_field(x, "video_ids")
-    )
-    flattened["selected_text"] = df["task_meta"].apply(
-        lambda x: extract_field(x, "selected_text")
-    )
-    flattened["mention_agents"] = df["task_meta"].apply(
-        lambda x: extract_field(x, "mention_agents")
-    )
+def _flatten_meta(task_metas: List, result_metas: List) -> Dict[str, List]:
+    columns: Dict[str, List] = {f: [] for f in TASK_META_FIELDS + RESULT_META_FIELDS}
+    for task_meta, result_meta in zip(task_metas, result_metas):
+        task = parse_meta(task_meta)
+        for field in TASK_META_FIELDS:
+            columns[field].append(task.get(field))
+        result = parse_meta(result_meta)
+        for field in RESULT_META_FIELDS:
+            columns[field].append(result.get(field))
+    return columns
+
+
+def flatten_task_data(df, workers=0, chunk_rows=50000):
+    """Flatten the task data by extracting specified fields from JSON.
 
-    # Extract markdown from result_meta
-    flattened["markdown"] = df["result_meta"].apply(
-        lambda x: extract_field(x, "markdown")
+    Each task_meta/result_meta blob is parsed once and all fields are extracted in
+    the same pass; with workers > 1 large frames are split across a process pool.
+    Raw or already-decoded (process_dataframe) columns are both accepted.
+    """
+    task_metas = df["task_meta"].tolist() if "task_meta" in df else [None] * len(df)
+    result_metas = (
+        df["result_meta"].tolist() if "result_meta" in df else [None] * len(df)
     )
 
-    # Select only the specified columns
-    columns_to_keep = [
-        "id",
-        "email",
-        "created_at",
-        "task_type",
-        "prompt",
-        "file_ids",
-        "texts",
-        "urls",
-        "image_urls",
-        "video_ids",
-        "selected_text",
-        "mention_agents",
-        "markdown",
-    ]
-
-    return flattened[columns_to_keep]
+    if workers > 1 and len(df) > chunk_rows:
+        starts = range(0, len(df), chunk_rows)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(
+                executor.map(
+                    _flatten_meta,
+                    [task_metas[i : i + chunk_rows] for i in starts],
+                    [result_metas[i : i + chunk_rows] for i in starts],
+                )
+            )
+        columns = {f: [v for part in parts for v in part[f]] for f in parts[0]}
+    else:
+        columns = _flatten_meta(task_metas, result_metas)
+
+    flattened = df[["id", "email", "created_at", "task_type"]].copy()
+    for field, values in columns.items():
+        flattened[field] = values
+    return flattened
+
+
+def write_parquet(df, path):
+    """Write flattened task data to Parquet, storing nested list/dict values as JSON strings."""
+    table_df = df.copy()
+    for column in TASK_META_FIELDS + RESULT_META_FIELDS:
+        if column not in table_df:
+            continue
+        table_df[column] = [
+            v if v is None or isinstance(v, str) else json.dumps(v, ensure_ascii=False)
+            for v in table_df[column]
+        ]
+    table_df.to_parquet(path, engine="pyarrow", index=False)
+    print(f"Saved {len(table_df)} rows to {path}")
 
 
 # def get_stripe_data(email: str) -> Dict:
@@ -486,24 +826,26 @@ def main():
     if not emails:
         return
 
-    # Query user data
-    df = query_user_data(emails, bigquery_client)
-    if df.empty:
+    # Query email and image_url only
+    profiles_df = query_user_profiles(emails, bigquery_client)
+    if profiles_df.empty:
         return
 
     # save email, image_url to csv
     # deduplicate by email
-    df = df.drop_duplicates(subset=["email"])
-    # df[['email', 'image_url', ""]].to_csv(os.path.join(output_dir, 'user_profiles.csv'), index=False)
+    profiles_df = profiles_df.drop_duplicates(subset=["email"])
     # merge image url into input_df
-    input_df = input_df.merge(df[["email", "image_url"]], on="email", how="left")
+    input_df = input_df.merge(
+        profiles_df[["email", "image_url"]], on="email", how="left"
+    )
     input_df.to_csv(os.path.join(output_dir, "user_profiles.csv"), index=False)
 
-    # # Process and decode unicode strings
-    # df = process_dataframe(df)
+    # # Query user data
+    # df = query_user_data(emails, bigquery_client)
 
-    # # Flatten task data
-    # df = flatten_task_data(df)
+    # # Flatten task data, each task_meta/result_meta blob is decoded once
+    # df = flatten_task_data(df, workers=os.cpu_count())
+    # write_parquet(df, os.path.join(output_dir, 'tasks.parquet'))
 
     # # Create user profiles with Auth0 data
     # user_profiles = pd.DataFrame({'email': df['email'].unique()})
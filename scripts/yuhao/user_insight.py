@@ -1,9 +1,15 @@
+import argparse
+import heapq
 import json
 import os
+import pickle
+import tempfile
+import threading
+from itertools import groupby
 from random import sample
-from typing import Dict, List
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 from openai import AzureOpenAI
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from datetime import datetime
 import pandas as pd
 from pathlib import Path
@@ -12,36 +18,98 @@ from dotenv import load_dotenv
 task = '1733835172.89993'
 report_name = f"{task}-report.md"
 
-def preprocess_user_data(data: pd.DataFrame) -> Dict[str, List[str]]:
+def estimate_tokens(text: str) -> int:
+    # rough estimate, about 4 characters per token
+    return len(text) // 4 + 1
+
+def cap_prompts(rows: List[Tuple], max_tokens: int) -> List[str]:
     """
-    Aggregate prompts by user_id in chronological order.
-    
-    Args:
-        data: DataFrame with columns [user_id, prompt, timestamp]
-    Returns:
-        Dict mapping user_id to list of ordered prompts
-    """
-    # Sort by timestamp and group by user_id
-    return (data
-            .sort_values('created_at')
-            .groupby('user_id')['prompt']
-            .agg(list)
-            .to_dict())
+    Order one user's (created_at, prompt) rows chronologically and keep the
+    most recent prompts that fit in max_tokens (<= 0 keeps everything).
+    """
+    rows.sort(key=lambda row: str(row[0]))
+    if max_tokens <= 0:
+        return [prompt for _, prompt in rows]
+    kept: List[str] = []
+    total = 0
+    for _, prompt in reversed(rows):
+        total += estimate_tokens(prompt)
+        if total > max_tokens and kept:
+            break
+        kept.append(prompt)
+    kept.reverse()
+    return kept
 
-def analyze_single_user(args: tuple) -> Dict:
+def read_prompt_chunks(csv_path: str, chunksize: int) -> Iterator[pd.DataFrame]:
+    # read user_id as text: per-chunk dtype inference would turn 5 into 5.0 in chunks
+    # with a missing value and split one user into two groups
+    for chunk in pd.read_csv(csv_path, usecols=['user_id', 'prompt', 'created_at'],
+                             dtype={'user_id': str}, chunksize=chunksize,
+                             on_bad_lines='skip', encoding='utf-8'):
+        yield chunk.dropna(subset=['user_id', 'prompt'])
+
+def write_sorted_run(rows: List[Tuple], path: Path):
     """
-    Analyze prompts for a single user.
+    Sort one chunk's (user_id, created_at, prompt) rows by user_id and pickle them to path.
     """
-    user_id, prompts, client, deployment_name = args
-    
-    # Load config file
-    with open('config.json', 'r') as f:
-        config = json.load(f)
-    
-    # Combine prompts into a single context
-    combined_prompt = "\n".join([f"Prompt {i+1}: {p}" for i, p in enumerate(prompts)])
-    
-    system_message = f"""
+    rows.sort(key=lambda row: str(row[0]))
+    with open(path, 'wb') as f:
+        for row in rows:
+            pickle.dump(row, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def read_sorted_run(path: Path) -> Iterator[Tuple]:
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+def group_user_rows(rows: Iterable[Tuple], max_tokens: int) -> Iterator[Tuple[Any, List[str]]]:
+    """
+    Group consecutive (user_id, created_at, prompt) rows of the same user.
+    """
+    for _, group in groupby(rows, key=lambda row: str(row[0])):
+        group = list(group)
+        yield group[0][0], cap_prompts([(created_at, prompt) for _, created_at, prompt in group], max_tokens)
+
+def iter_user_prompts(csv_path: str, max_tokens: int = 0, chunksize: int = 100_000,
+                      presorted: bool = False) -> Iterator[Tuple[Any, List[str]]]:
+    """
+    Stream (user_id, prompts) pairs without loading the whole CSV.
+
+    If the export is already grouped by user_id (presorted), users are emitted as
+    soon as their last row is read. Otherwise the CSV is sorted externally: each
+    chunk is sorted by user_id into a temporary run file, then the runs are merged
+    and users are emitted one at a time in user_id order. In that case nothing is
+    emitted until the whole CSV has been read and spilled to the run files, so
+    classification only starts after this first pass.
+    Either way peak memory is bounded by one chunk plus the largest user, and each
+    user's prompts are capped at max_tokens, keeping the most recent ones.
+    user_id is yielded as the string read from the CSV, the same key used by --resume.
+    """
+    def iter_rows(chunk: pd.DataFrame) -> Iterator[Tuple]:
+        return zip(chunk['user_id'], chunk['created_at'], chunk['prompt'].astype(str))
+
+    if presorted:
+        rows = (row for chunk in read_prompt_chunks(csv_path, chunksize) for row in iter_rows(chunk))
+        yield from group_user_rows(rows, max_tokens)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths: List[Path] = []
+        for chunk in read_prompt_chunks(csv_path, chunksize):
+            path = Path(tmp_dir) / f"run_{len(paths)}.pkl"
+            write_sorted_run(list(iter_rows(chunk)), path)
+            paths.append(path)
+        runs = [read_sorted_run(path) for path in paths]
+        yield from group_user_rows(heapq.merge(*runs, key=lambda row: str(row[0])), max_tokens)
+
+def build_system_message(config: Dict) -> str:
+    """
+    Render the classification system message once per run.
+    """
+    return f"""
         You are a helpful assistant tasked with classifying user prompts. You specialize in accurately classifying rather than guessing. You prefer to return 'Unknown' or '[]' for lists unless you have full confidence.
     For each input, respond with the following:
     - Occupations: Based on the prompt, infer 2-3 the user's possible occupations from this list: {config['occupations']} or "Unknown" if unclear.
@@ -56,6 +124,15 @@ def analyze_single_user(args: tuple) -> Dict:
         "dissatisfied": "true/false/unknown"
     }}"""
 
+def analyze_single_user(args: tuple) -> Dict:
+    """
+    Analyze prompts for a single user.
+    """
+    user_id, prompts, client, deployment_name, system_message = args
+    
+    # Combine prompts into a single context
+    combined_prompt = "\n".join([f"Prompt {i+1}: {p}" for i, p in enumerate(prompts)])
+
     try:
         response = client.chat.completions.create(
             model=deployment_name,
@@ -79,42 +156,123 @@ def analyze_single_user(args: tuple) -> Dict:
             "topics": [],
             "task_type": "unknown",
             "tags": [],
-            "dissatisfied": "unknown"
+            "dissatisfied": "unknown",
+            "error": str(e)
         }
 
-def analyze_users(data: pd.DataFrame, client: AzureOpenAI, deployment_name: str, max_workers: int = 200) -> List[Dict]:
+class ResultWriter:
     """
-    Analyze all users concurrently.
+    Append each user's result to a JSONL file as soon as it completes,
+    so a crashed run keeps everything finished so far.
     """
-    # Preprocess data
-    user_prompts = preprocess_user_data(data)
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def append(self, result: Dict):
+        line = json.dumps(result, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+def load_done_user_ids(path: Path) -> Set[str]:
+    """
+    Users already analyzed successfully in a previous run of the same task.
+    Failed users are not counted so a resumed run retries them.
+    """
+    done: Set[str] = set()
+    if not path.exists():
+        return done
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may be cut off by a crash
+                continue
+            if "error" in result:
+                continue
+            done.add(str(result.get("user_id")))
+    return done
+
+def analyze_users(user_prompts: Iterable[Tuple[Any, List[str]]], client: AzureOpenAI, deployment_name: str,
+                  system_message: str, writer: ResultWriter, done: Optional[Set[str]] = None,
+                  max_workers: int = 200) -> int:
+    """
+    Analyze users concurrently as they are streamed in, writing each result into the writer.
+    At most 2 * max_workers users are held in flight. Users in done are skipped.
+    Returns the number of users analyzed.
+    """
+    done = done or set()
     
-    # Prepare arguments for concurrent execution
     # # random sample 100 users
     # user_prompts = dict(sample(list(user_prompts.items()), 100))
-    args_list = [(user_id, prompts, client, deployment_name) 
-                 for user_id, prompts in user_prompts.items()]
-    
-    # Run analysis concurrently
-    results = []
+    count = 0
+    skipped = 0
+    pending = set()
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        results = list(executor.map(analyze_single_user, args_list))
+        for user_id, prompts in user_prompts:
+            if str(user_id) in done:
+                skipped += 1
+                continue
+            pending.add(executor.submit(analyze_single_user,
+                                        (user_id, prompts, client, deployment_name, system_message)))
+            if len(pending) < 2 * max_workers:
+                continue
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                writer.append(future.result())
+                count += 1
+        for future in as_completed(pending):
+            writer.append(future.result())
+            count += 1
     
-    return results
+    print(f"Analyzed {count} users, skipped {skipped} already done")
+    return count
+
+def results_path(output_dir: str = "outputs") -> Path:
+    return Path(output_dir) / f"user_analysis_{task}.jsonl"
 
-def save_results(results: List[Dict], output_dir: str = "outputs"):
+def save_results(jsonl_path: Path, output_dir: str = "outputs"):
     """
-    Save analysis results to JSON file.
+    Collect the streamed JSONL results into a single JSON file,
+    keeping the latest result for each user.
     """
+    results: Dict[str, Dict] = {}
+    with open(jsonl_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            results[str(result.get("user_id"))] = result
+
     Path(output_dir).mkdir(exist_ok=True)
     output_path = Path(output_dir) / f"user_analysis_{task}.json"
     
     with open(output_path, 'w') as f:
-        json.dump(results, f, indent=2)
+        json.dump(list(results.values()), f, indent=2)
     
     print(f"Results saved to {output_path}")
 
 def main():
+    parser = argparse.ArgumentParser(description="Classify users by their prompts")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip users already analyzed in the task's JSONL results")
+    parser.add_argument("--max-workers", type=int, default=200)
+    parser.add_argument("--max-user-tokens", type=int, default=0,
+                        help="Keep only the most recent prompts within this many tokens per user (0 = no cap)")
+    parser.add_argument("--chunksize", type=int, default=100_000, help="CSV rows read per chunk")
+    parser.add_argument("--presorted", action="store_true",
+                        help="The CSV is already grouped by user_id, stream users without sorting")
+    args = parser.parse_args()
+
     # read the api key from .env
     load_dotenv()
     api_key = os.getenv("azure_api_key")
@@ -128,39 +286,31 @@ def main():
         azure_endpoint=endpoint,
     )
     
-    # Try different options to read potentially problematic CSV
+    # Stream users out of the CSV, grouped and capped per user
+    user_prompts = iter_user_prompts(f"{task}.csv", max_tokens=args.max_user_tokens,
+                                     chunksize=args.chunksize, presorted=args.presorted)
+
+    # Load config and render the system message once
+    with open('config.json', 'r') as f:
+        config = json.load(f)
+    system_message = build_system_message(config)
+
+    jsonl_path = results_path()
+    if not args.resume and jsonl_path.exists():
+        jsonl_path.unlink()
+    done = load_done_user_ids(jsonl_path) if args.resume else set()
+
+    # Run analysis, results are appended to the JSONL file as each user completes
+    writer = ResultWriter(jsonl_path)
     try:
-        df = pd.read_csv(f"{task}.csv", on_bad_lines='skip', encoding='utf-8')
-    except Exception as e:
-        print(f"First attempt failed: {e}")
-        try:
-            # Try with a different engine
-            df = pd.read_csv(f"{task}.csv", engine='python', encoding='utf-8')
-        except Exception as e:
-            print(f"Second attempt failed: {e}")
-            # Last resort: try with a larger field size limit
-            import sys
-            import csv
-            maxInt = sys.maxsize
-            while True:
-                try:
-                    csv.field_size_limit(maxInt)
-                    break
-                except OverflowError:
-                    maxInt = int(maxInt/10)
-            df = pd.read_csv(f"{task}.csv", encoding='utf-8')
-    
-    print(f"Loaded {task}.csv")
-    print(f"Shape: {df.shape}")
-    print(df.head())
-    # # use the top 2000 rows for analysis to testing
-    # df = df.head(2000)
-
-    # Run analysis
-    results = analyze_users(df, client, deployment_name)
+        count = analyze_users(user_prompts, client, deployment_name, system_message, writer,
+                              done=done, max_workers=args.max_workers)
+    finally:
+        writer.close()
+    print(f"Analyzed {count} users, results streamed to {jsonl_path}")
     
     # Save results
-    save_results(results)
+    save_results(jsonl_path)
 
 if __name__ == "__main__":
     main()
@@ -1,11 +1,12 @@
+import argparse
 import csv
-from typing import List
-from openpyxl import load_workbook
+import os
+import sys
+import time
+from collections import Counter
+from typing import Dict, Iterator, List, Optional, Tuple
 from datetime import datetime, timedelta
 
-user_results = {}
-occupations = {}
-industry = {}
 industry_categories = {
     "Education": "Education",
     "Technology / IT": "Technology / IT",
@@ -23,93 +24,194 @@ industry_categories = {
 }
 
 
-def read_csv_file(filepath: str):
+class RowWriter(object):
     """
-    读取 CSV 文件并返回列表形式的数据（含表头）
+    逐行写出结果, 写csv或者按批写parquet, 内存只保留一个批次
     """
-    with open(filepath, newline="", encoding="utf-8") as csvfile:
-        reader = csv.reader(csvfile)
-        data = [row for row in reader]
-    return data
-
-
-def load_user_results():
-    data = read_csv_file("./results/results.csv")
-    for i in range(len(data)):
-        if i == 0:
-            header = data[i]
-            continue
-        user_results[data[i][0]] = data[i]
-    return header
 
+    def __init__(self, filepath: str, header: List[str], parquet: bool = False):
+        self.filepath = filepath
+        self.header = header
+        self.count = 0
+        self._parquet = parquet
+        self._batch: List[List[str]] = []
+        self._batch_size = 50000
+        if parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            self._schema = pa.schema([(name, pa.string()) for name in header])
+            self._writer = pq.ParquetWriter(filepath, self._schema)
+        else:
+            self._file = open(filepath, "w", newline="", encoding="utf-8")
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(header)
+
+    def write(self, row: List[str]):
+        self.count += 1
+        if not self._parquet:
+            self._writer.writerow(row)
+            return
+        self._batch.append(row)
+        if len(self._batch) >= self._batch_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._batch:
+            return
+        import pyarrow as pa
+
+        columns = list(zip(*self._batch))
+        self._writer.write_table(
+            pa.Table.from_arrays(
+                [pa.array(column, pa.string()) for column in columns],
+                schema=self._schema,
+            )
+        )
+        self._batch = []
+
+    def close(self):
+        if self._parquet:
+            self._flush()
+            self._writer.close()
+        else:
+            self._file.close()
+        print(f"文件已创建：{self.filepath}, rows: {self.count}")
 
-def cluster():
-    rows = []
-    for k, v in occupations.items():
-        rows.append(k)
-    print(f"occupations: {rows}")
 
-    rows = []
-    for k, v in industry.items():
-        rows.append(k)
-    print(f"industry: {rows}")
+def cluster(occupations: Counter, industry: Counter):
+    print(f"occupations: {occupations.most_common()}")
+    print(f"industry: {industry.most_common()}")
 
 
-def is_recent(dt_str: str) -> bool:
+def is_recent(dt_str: str, now: Optional[datetime] = None, days: int = 14) -> bool:
     if not dt_str:
         return False
-    # 解析为 datetime 对象
-    dt = datetime.strptime(dt_str, "%Y-%m-%dT%H:%M:%S")
+    # 解析为 datetime 对象, 格式为 %Y-%m-%dT%H:%M:%S
+    dt = datetime.fromisoformat(dt_str)
 
     # 当前时间
-    now = datetime.now()
+    now = now or datetime.now()
 
-    # 三个月前的时间（粗略以90天计算）
-    three_months_ago = now - timedelta(days=14)
+    # 判断是否在最近days天内
+    return now - timedelta(days=days) <= dt <= now
 
-    # 判断是否在最近三个月内
-    return three_months_ago <= dt <= now
 
+def read_csv_rows(filepath: str) -> Iterator[List[str]]:
+    with open(filepath, newline="", encoding="utf-8") as csvfile:
+        for row in csv.reader(csvfile):
+            yield row
 
-def upload():
-    header = load_user_results()
-    # print("--", header)
-    # print("xx", user_results["malecaroh#gmail.com"])
-    rows = []
-    guests = []
-    for k, v in user_results.items():
-        row = list()
-        isGuest = False
-        for column in range(len(v)):
-            value = v[column]
-            if header[column] == "is_guest_mode" and value == "true":
-                isGuest = True
-            if value == "<nil>" or value == "":
-                value = "-"
-            if header[column] == "is_student" or header[column] == "gender":
-                value = value.lower()
-            if header[column] == "occupation":
-                occupations[value] = 1
-            if header[column] == "industry":
-                industry[value] = 1
-
-            row.append(value)
-
-        if isGuest:
-            guests.append(row)
+
+def read_store_rows(store_path: str) -> Iterator[List[str]]:
+    """
+    从jobs/store.py的本地结果库读取每个用户最新的结果, 第一行为表头
+    """
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs"))
+    from store import ResultStore
+
+    store = ResultStore(store_path)
+    header: List[str] = []
+    for row in store.iter_latest():
+        if not header:
+            header = list(row.keys())
+            yield header
+        yield ["" if row.get(k) is None else str(row.get(k)) for k in header]
+    store.close()
+
+
+def last_row_numbers(filepath: str) -> Dict[str, int]:
+    """
+    每个user_id最后一次出现的行号(不含表头, 从0开始)
+    """
+    last: Dict[str, int] = {}
+    reader = read_csv_rows(filepath)
+    next(reader, None)
+    for number, row in enumerate(reader):
+        if row:
+            last[row[0]] = number
+    return last
+
+
+def split(
+    filepath: str = "./results/results.csv",
+    output_dir: str = ".",
+    parquet: bool = False,
+    rows: Optional[Iterator[List[str]]] = None,
+) -> Tuple[Counter, Counter]:
+    """
+    单次流式读取结果文件, 按是否是guest写到两个文件里, 同时统计occupation和industry的分布
+    同一个user_id只保留最后一次出现的行, 和原来按user_id写dict的结果一致:
+    读文件时先扫一遍记下每个user_id最后出现的行号, 第二遍只写这些行
+    内存随user_id的数量增长(每个user_id一个行号), 但不保留行的内容
+    rows不为空时直接使用rows(第一行为表头), 例如来自本地结果库, 其中每个user_id只有一行, 不再去重
+    比表头短的行用"-"补齐
+    """
+    occupations: Counter = Counter()
+    industry: Counter = Counter()
+    ext = "parquet" if parquet else "csv"
+    reader = rows if rows is not None else read_csv_rows(filepath)
+    header = next(reader, None)
+    if header is None:
+        return occupations, industry
+    columns: Dict[str, int] = {name: i for i, name in enumerate(header)}
+    guest_column = columns.get("is_guest_mode", -1)
+    occupation_column = columns.get("occupation", -1)
+    industry_column = columns.get("industry", -1)
+    lower_columns = [
+        columns[name] for name in ["is_student", "gender"] if name in columns
+    ]
+
+    predicts = RowWriter(os.path.join(output_dir, f"predict.{ext}"), header, parquet)
+    guests = RowWriter(
+        os.path.join(output_dir, f"predict_guest.{ext}"), header, parquet
+    )
+    last = last_row_numbers(filepath) if rows is None else None
+    for number, row in enumerate(reader):
+        if not row or (last is not None and last.get(row[0]) != number):
+            continue
+        if len(row) < len(header):
+            row = row + [""] * (len(header) - len(row))
+
+        is_guest = guest_column >= 0 and row[guest_column] == "true"
+        row = ["-" if value == "<nil>" or value == "" else value for value in row]
+        for column in lower_columns:
+            row[column] = row[column].lower()
+        if occupation_column >= 0:
+            occupations[row[occupation_column]] += 1
+        if industry_column >= 0:
+            industry[row[industry_column]] += 1
+
+        if is_guest:
+            guests.write(row)
         else:
-            rows.append(row)
-    create_csv_file("./predict.csv", header, rows)
-    create_csv_file("./predict_guest.csv", header, guests)
+            predicts.write(row)
 
+    predicts.close()
+    guests.close()
 
-def create_csv_file(filepath, header, rows):
-    with open(filepath, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(header)
-        writer.writerows(rows)
+    return occupations, industry
 
-    print(f"CSV 文件已创建：{filepath}")
+
+def upload():
+    parser = argparse.ArgumentParser(description="split predict results by guest mode")
+    parser.add_argument("--input-file", default="./results/results.csv")
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--parquet", action="store_true", help="write parquet files")
+    parser.add_argument(
+        "--store", default="", help="read the latest rows from a local results store"
+    )
+    args = parser.parse_args()
+
+    start = time.time()
+    occupations, industry = split(
+        filepath=args.input_file,
+        output_dir=args.output_dir,
+        parquet=args.parquet,
+        rows=read_store_rows(args.store) if args.store else None,
+    )
+    cluster(occupations, industry)
+    print(f"cost: {time.time() - start:.2f}s")
 
 
 if __name__ == "__main__":